@@ -0,0 +1,445 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Offline scaling benchmark for ingestion and provisioning.
+
+Runs validate_update_dyno, get_ou_map, get_items, the lambda_handler
+provisioning chain and a re-ingestion of the file with a few rows added
+against moto (Organizations, DynamoDB, S3) and an
+in-process Service Catalog stand-in for synthetic orgs and CSV files, and
+reports wall time, API calls per operation and peak Python memory.
+
+    pip install boto3 "moto[dynamodb,organizations,s3]"
+    python bench_scale.py                  # small scale, print results
+    python bench_scale.py --scale full     # 10,000 rows / 1,000 OUs
+    python bench_scale.py --save           # store results as the baseline
+    python bench_scale.py --compare        # fail on API call regressions
+
+API call counts are deterministic and compared exactly (within
+--tolerance); wall time and memory include moto's own overhead and are
+only reported.
+'''
+
+import os
+import sys
+import io
+import csv
+import json
+import logging
+import argparse
+import tracemalloc
+from time import perf_counter
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'source'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ['TABLE_NAME'] = 'BenchAccountTable'
+os.environ['STATE_TABLE_NAME'] = 'BenchStateTable'
+os.environ['BATCH_BUCKET_NAME'] = 'bench-bucket'
+os.environ['BATCH_KEY_NAME'] = 'bench.csv'
+os.environ['PRINCIPAL_ARN'] = 'arn:aws:iam::123456789012:role/bench'
+
+from moto import mock_aws  # noqa: E402
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Rows appended to the file before it is ingested a second time
+ADDED_ROWS = 5
+# (csv rows, OUs, existing accounts, accounts provisioned through the chain)
+SCALES = {
+    'small': [(10, 10, 100, 10), (100, 50, 500, 25), (1000, 100, 1000, 50)],
+    'full': [(10, 10, 100, 10), (1000, 100, 1000, 100),
+             (10000, 1000, 10000, 300)]
+    }
+OU_FANOUT = 5
+
+
+class Context:
+    '''Minimal Lambda context'''
+
+    log_stream_name = 'bench'
+
+    @staticmethod
+    def get_remaining_time_in_millis():
+        '''Never run out of time during the benchmark'''
+
+        return 900000
+
+
+class ServiceCatalog:
+    '''In-process stand-in for the Account Factory calls of account_create'''
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.products = dict()
+        self.tokens = dict()
+
+    def count(self, name):
+        '''Record one call'''
+
+        self.calls['servicecatalog.' + name] += 1
+
+    def search_products_as_admin(self, **kwargs):
+        '''Return the Account Factory product'''
+
+        self.count('SearchProductsAsAdmin')
+        return {'ProductViewDetails': [{'ProductViewSummary': {
+            'Name': 'AWS Control Tower Account Factory',
+            'ProductId': 'prod-bench'}}]}
+
+    def describe_product_as_admin(self, **kwargs):
+        '''Return one provisioning artifact'''
+
+        self.count('DescribeProductAsAdmin')
+        return {'ProvisioningArtifactSummaries': [{'Id': 'pa-bench'}]}
+
+    def list_portfolios_for_product(self, **kwargs):
+        '''Return the Control Tower portfolio'''
+
+        self.count('ListPortfoliosForProduct')
+        return {'PortfolioDetails': [{'ProviderName': 'AWS Control Tower',
+                                      'Id': 'port-bench'}]}
+
+    def get_paginator(self, name):
+        '''Return a paginator listing PRINCIPAL_ARN as associated'''
+
+        calls = self.calls
+
+        class Paginator:
+            '''list_principals_for_portfolio paginator'''
+
+            @staticmethod
+            def paginate(**kwargs):
+                '''Yield a single page'''
+
+                calls['servicecatalog.ListPrincipalsForPortfolio'] += 1
+                yield {'Principals': [
+                    {'PrincipalARN': os.environ['PRINCIPAL_ARN']}]}
+
+        return Paginator()
+
+    def provision_product(self, **kwargs):
+        '''Launch an account, once per ProvisionToken'''
+
+        self.count('ProvisionProduct')
+        token = kwargs['ProvisionToken']
+        if token not in self.tokens:
+            pp_id = 'pp-' + str(len(self.products)).zfill(12)
+            params = {p['Key']: p['Value']
+                      for p in kwargs['ProvisioningParameters']}
+            self.products[pp_id] = params['AccountName']
+            self.tokens[token] = pp_id
+        return {'RecordDetail': {'ProvisionedProductId': self.tokens[token]}}
+
+    def describe_provisioned_product(self, **kwargs):
+        '''Every launch is still under change'''
+
+        self.count('DescribeProvisionedProduct')
+        return {'ProvisionedProductDetail': {'Status': 'UNDER_CHANGE'}}
+
+
+def count_calls(clients, calls):
+    '''Count every API call made through the shared clients'''
+
+    def before_call(model, **kwargs):
+        calls[model.service_model.endpoint_prefix + '.' + model.name] += 1
+
+    for client in clients:
+        client.meta.events.register('before-call', before_call)
+
+
+def build_org(org, ous, accounts):
+    '''Create an organization with ous OUs and accounts accounts'''
+
+    root_id = org.list_roots()['Roots'][0]['Id']
+    parents = [root_id]
+    ou_ids = list()
+
+    while len(ou_ids) < ous:
+        parent = parents[len(ou_ids) // OU_FANOUT]
+        ou_id = org.create_organizational_unit(
+            ParentId=parent, Name='Bench-OU-' + str(len(ou_ids)))[
+                'OrganizationalUnit']['Id']
+        ou_ids.append(ou_id)
+        parents.append(ou_id)
+
+    for index in range(accounts):
+        org.create_account(Email='existing-%s@example.com' % index,
+                           AccountName='Existing-%s' % index)
+
+    return ou_ids
+
+
+def build_csv(rows, ou_ids, start=0):
+    '''
+    Return CSV content with rows accounts numbered from start, every
+    tenth one INVALID
+    '''
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['AccountName', 'SSOUserEmail', 'AccountEmail',
+                     'SSOUserFirstName', 'SSOUserLastName', 'OrgUnit'])
+
+    for index in range(start, start + rows):
+        ou_index = index % len(ou_ids)
+        email = 'bench-%s@example.com' % index
+        if index % 10 == 9:
+            email = 'existing-0@example.com'
+        writer.writerow(['Bench-account-%s' % index,
+                         'sso-%s@example.com' % index, email,
+                         'First', 'Last',
+                         'Bench-OU-%s (%s)' % (ou_index, ou_ids[ou_index])])
+
+    return output.getvalue()
+
+
+def create_tables(dyno):
+    '''Create the account and state tables as in BatchAccountCreation.yaml'''
+
+    dyno.create_table(
+        TableName=os.environ['TABLE_NAME'],
+        KeySchema=[{'AttributeName': 'AccountName', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'AccountName', 'AttributeType': 'S'},
+            {'AttributeName': 'QueueStatus', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'QueueIndex',
+            'KeySchema': [{'AttributeName': 'QueueStatus',
+                           'KeyType': 'HASH'},
+                          {'AttributeName': 'AccountName',
+                           'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}}],
+        BillingMode='PAY_PER_REQUEST',
+        StreamSpecification={'StreamEnabled': True,
+                             'StreamViewType': 'NEW_AND_OLD_IMAGES'})
+    dyno.create_table(
+        TableName=os.environ['STATE_TABLE_NAME'],
+        KeySchema=[{'AttributeName': 'StateKey', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'StateKey', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+
+
+def measure(name, calls, func, *args):
+    '''Run func and return (result, measurement)'''
+
+    calls.clear()
+    tracemalloc.start()
+    started = perf_counter()
+    result = func(*args)
+    elapsed = perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (result, {'name': name,
+                     'seconds': round(elapsed, 3),
+                     'peak_kib': peak // 1024,
+                     'calls': dict(sorted(calls.items())),
+                     'total_calls': sum(calls.values())})
+
+
+def lifecycle_event(account_name, state='SUCCEEDED'):
+    '''Return a CreateManagedAccount lifecycle event'''
+
+    return {'source': 'aws.controltower', 'detail': {
+        'serviceEventDetails': {'createManagedAccountStatus': {
+            'state': state, 'message': 'bench',
+            'account': {'accountId': '111111111111',
+                        'accountName': account_name}}}}}
+
+
+def run_chain(account_create, launches):
+    '''
+    Drive lambda_handler from the CloudFormation Create event through
+    lifecycle events until launches accounts have been provisioned
+    '''
+
+    account_create.lambda_handler(
+        {'RequestType': 'Create', 'ResponseURL': '', 'StackId': '',
+         'RequestId': '', 'LogicalResourceId': ''}, Context())
+    done = 0
+
+    while done < launches:
+        in_flight = account_create.get_items('IN_PROGRESS')
+        if not in_flight:
+            break
+        for item in in_flight:
+            account_create.lambda_handler(
+                lifecycle_event(item['AccountName']['S']), Context())
+            done += 1
+
+    return done
+
+
+def run_scale(rows, ous, accounts, launches, rate_limits):
+    '''Return measurements for one synthetic org and CSV size'''
+
+    results = list()
+    calls = Counter()
+
+    with mock_aws():
+        import awsclients
+        if not rate_limits:
+            awsclients.RATE_LIMITS.clear()
+        awsclients.CLIENTS.clear()
+        for module in ('dynotable', 'orgcache', 'new_account_handler',
+                       'account_create'):
+            sys.modules.pop(module, None)
+        import apimetrics
+        import cfnresource
+        import orgcache
+        import new_account_handler
+        import account_create
+
+        cfnresource.send = lambda *args, **kwargs: None
+        apimetrics.flush = lambda *args, **kwargs: None
+        account_create.SC = ServiceCatalog(calls)
+        count_calls([awsclients.get_client(service) for service in
+                     ('dynamodb', 'organizations', 's3')], calls)
+
+        org = new_account_handler.ORG
+        org.create_organization(FeatureSet='ALL')
+        ou_ids = build_org(org, ous, accounts)
+        create_tables(new_account_handler.DYNO)
+        new_account_handler.SSS.create_bucket(
+            Bucket=os.environ['BATCH_BUCKET_NAME'])
+        new_account_handler.SSS.put_object(
+            Bucket=os.environ['BATCH_BUCKET_NAME'],
+            Key=os.environ['BATCH_KEY_NAME'],
+            Body=build_csv(rows, ou_ids).encode('utf-8'))
+
+        results.append(measure('get_ou_map', calls,
+                               new_account_handler.get_ou_map)[1])
+        orgcache.CACHE.clear()
+        (_, result) = measure(
+            'validate_update_dyno', calls,
+            lambda: new_account_handler.validate_update_dyno(
+                new_account_handler.read_file(
+                    os.environ['BATCH_BUCKET_NAME'],
+                    os.environ['BATCH_KEY_NAME']),
+                os.environ['TABLE_NAME']))
+        results.append(result)
+        results.append(measure('get_items', calls,
+                               account_create.get_items, 'VALID')[1])
+        (done, result) = measure('provisioning_chain', calls, run_chain,
+                                 account_create, launches)
+        result['accounts_provisioned'] = done
+        results.append(result)
+        new_account_handler.SSS.put_object(
+            Bucket=os.environ['BATCH_BUCKET_NAME'],
+            Key=os.environ['BATCH_KEY_NAME'],
+            Body=(build_csv(rows, ou_ids) + build_csv(
+                ADDED_ROWS, ou_ids, rows).split('\n', 1)[1]).encode('utf-8'))
+        (_, result) = measure(
+            'reingest_delta', calls,
+            lambda: new_account_handler.validate_update_dyno(
+                new_account_handler.read_file(
+                    os.environ['BATCH_BUCKET_NAME'],
+                    os.environ['BATCH_KEY_NAME']),
+                os.environ['TABLE_NAME']))
+        results.append(result)
+
+    for result in results:
+        result['scale'] = {'rows': rows, 'ous': ous, 'accounts': accounts,
+                           'launches': launches}
+
+    return results
+
+
+def key(result):
+    '''Return the baseline lookup key of a measurement'''
+
+    scale = result['scale']
+    return '%s/rows=%s/ous=%s/accounts=%s/launches=%s' % (
+        result['name'], scale['rows'], scale['ous'], scale['accounts'],
+        scale['launches'])
+
+
+def compare(results, tolerance):
+    '''
+    Return regressions of total API calls against the saved baseline. A
+    result missing from the baseline is a regression too, so a scale
+    that was never saved cannot pass unchecked.
+    '''
+
+    regressions = list()
+
+    with open(BASELINE, encoding='utf-8') as file:
+        baseline = {key(result): result for result in json.load(file)}
+
+    for result in results:
+        previous = baseline.get(key(result))
+        if previous is None:
+            regressions.append('%s: no baseline entry, save one with '
+                               '--save' % key(result))
+        elif result['total_calls'] > \
+                previous['total_calls'] * (1 + tolerance):
+            regressions.append('%s: %s API calls, baseline %s' % (
+                key(result), result['total_calls'],
+                previous['total_calls']))
+
+    return regressions
+
+
+def main():
+    '''Run the benchmark'''
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='exit 1 if API calls regressed vs baseline')
+    parser.add_argument('--tolerance', type=float, default=0.0)
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep client-side API rate limits enabled')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    results = list()
+
+    for (rows, ous, accounts, launches) in SCALES[args.scale]:
+        for result in run_scale(rows, ous, accounts, launches,
+                                args.rate_limits):
+            results.append(result)
+            print('%-60s %8.3fs %8s calls %8s KiB' % (
+                key(result), result['seconds'], result['total_calls'],
+                result['peak_kib']))
+
+    if args.save:
+        with open(BASELINE, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    if args.compare:
+        regressions = compare(results, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Discrete-event simulator of Control Tower account provisioning.
+
+Drives account_create.lambda_handler through a whole batch with an
+in-process Service Catalog (Account Factory) that completes launches
+after a sampled latency and then emits the aws.controltower
+CreateManagedAccount event, plus the scheduled sweep. DynamoDB and
+Organizations run on moto. Time is virtual: the clock jumps to the next
+event, so a 1,000-account batch that takes days in a landing zone runs
+in minutes, and --compression N instead paces it at N virtual seconds
+per real second.
+
+    pip install boto3 "moto[dynamodb,organizations,s3]"
+    python simulate_ct.py --accounts 1000 --concurrency 5
+    python simulate_ct.py --accounts 200 --ct-limit 3 --throttle-rate 0.1 \
+        --fail-rate 0.05 --latency uniform --latency-spread 0.5
+
+Prints scheduler throughput (virtual accounts/hour and mean accounts in
+flight), outcomes, Lambda invocations and API calls per operation.
+'''
+
+import os
+import sys
+import json
+import heapq
+import random
+import logging
+import argparse
+from math import exp
+from time import perf_counter, sleep, time
+from collections import Counter
+from botocore.exceptions import ClientError
+
+import bench_scale
+from bench_scale import mock_aws
+
+SWEEP_INTERVAL = 300
+LATENCY_MODELS = ('lognormal', 'uniform', 'fixed')
+
+
+class VirtualClock:
+    '''Simulated epoch time, advanced by the event loop'''
+
+    def __init__(self, start, compression=0.0):
+        self.now = start
+        self.compression = compression
+
+    def time(self):
+        '''Return the virtual time'''
+
+        return self.now
+
+    def advance_to(self, when):
+        '''Move the clock forward, pacing it if compression is set'''
+
+        if when > self.now:
+            if self.compression:
+                sleep((when - self.now) / self.compression)
+            self.now = when
+
+    def sleep(self, seconds):
+        '''Stand-in for time.sleep that only advances the clock'''
+
+        self.advance_to(self.now + seconds)
+
+
+class Latency:
+    '''Launch-to-completion latency distribution'''
+
+    def __init__(self, model, median, spread, rng):
+        self.model = model
+        self.median = median
+        self.spread = spread
+        self.rng = rng
+
+    def sample(self):
+        '''Return one latency in seconds'''
+
+        result = self.median
+
+        if self.model == 'lognormal':
+            result = self.median * exp(self.rng.gauss(0, self.spread))
+        elif self.model == 'uniform':
+            result = self.median * (1 + self.rng.uniform(-self.spread,
+                                                         self.spread))
+
+        return max(1.0, result)
+
+
+class ServiceCatalog(bench_scale.ServiceCatalog):
+    '''
+    In-process Account Factory. At most ct_limit launches run at once;
+    launches beyond it, and a throttle_rate share of all calls to
+    provision_product, are rejected. A fail_rate share of launches end
+    in ERROR with a FAILED lifecycle event.
+    '''
+
+    def __init__(self, clock, latency, rng, options):
+        super().__init__(Counter())
+        self.clock = clock
+        self.latency = latency
+        self.rng = rng
+        self.options = options
+        self.schedule = None
+
+    def in_flight(self):
+        '''Return number of launches under change'''
+
+        return sum(1 for product in self.products.values()
+                   if product['Status'] == 'UNDER_CHANGE')
+
+    def provision_product(self, **kwargs):
+        '''Launch an account, once per ProvisionToken'''
+
+        self.count('ProvisionProduct')
+        token = kwargs['ProvisionToken']
+
+        if token in self.tokens:
+            return {'RecordDetail': {
+                'ProvisionedProductId': self.tokens[token]}}
+        if self.rng.random() < self.options.throttle_rate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException',
+                                         'Message': 'Rate exceeded'}},
+                              'ProvisionProduct')
+        if self.in_flight() >= self.options.ct_limit:
+            raise ClientError({'Error': {
+                'Code': 'InvalidParametersException',
+                'Message': 'Another Account Factory operation is in '
+                           'progress'}}, 'ProvisionProduct')
+
+        pp_id = 'pp-' + str(len(self.products)).zfill(12)
+        params = {p['Key']: p['Value']
+                  for p in kwargs['ProvisioningParameters']}
+        failed = self.rng.random() < self.options.fail_rate
+        self.products[pp_id] = {
+            'Id': pp_id, 'Status': 'UNDER_CHANGE',
+            'LastRecordId': 'rec-' + pp_id[3:],
+            'AccountName': params['AccountName'],
+            'Outcome': 'FAILED' if failed else 'SUCCEEDED'}
+        self.tokens[token] = pp_id
+        self.schedule(self.clock.time() + self.latency.sample(),
+                      'complete', pp_id)
+
+        return {'RecordDetail': {'ProvisionedProductId': pp_id}}
+
+    def complete(self, pp_id):
+        '''Finish a launch. Return its CreateManagedAccount event'''
+
+        product = self.products[pp_id]
+        product['Status'] = 'AVAILABLE' \
+            if product['Outcome'] == 'SUCCEEDED' else 'ERROR'
+        event = bench_scale.lifecycle_event(product['AccountName'],
+                                            product['Outcome'])
+        event['detail']['serviceEventDetails']['createManagedAccountStatus'][
+            'account']['accountId'] = str(100000000000 + int(pp_id[3:]))
+
+        return event
+
+    def describe_provisioned_product(self, Id, **kwargs):
+        '''Return the state of a launch'''
+
+        self.count('DescribeProvisionedProduct')
+        product = self.products[Id]
+        return {'ProvisionedProductDetail': {
+            'Id': Id, 'Status': product['Status'],
+            'LastRecordId': product['LastRecordId']}}
+
+    def describe_record(self, Id, **kwargs):
+        '''Return the errors of a failed launch'''
+
+        self.count('DescribeRecord')
+        return {'RecordDetail': {'RecordErrors': [
+            {'Code': 'SimulatedFailure',
+             'Description': 'Simulated Account Factory failure'}]}}
+
+
+class Simulation:
+    '''Event queue and counters of one simulated batch'''
+
+    def __init__(self, clock, handler):
+        self.clock = clock
+        self.handler = handler
+        self.queue = list()
+        self.sequence = 0
+        self.invocations = Counter()
+
+    def schedule(self, when, kind, payload):
+        '''Queue an event for virtual time when'''
+
+        self.sequence += 1
+        heapq.heappush(self.queue, (when, self.sequence, kind, payload))
+
+    def invoke(self, kind, event):
+        '''Run lambda_handler with an event'''
+
+        self.invocations[kind] += 1
+        return self.handler(event, bench_scale.Context())
+
+
+def remaining(dynotable, calls):
+    '''Return VALID plus IN_PROGRESS rows, not counting the read as load'''
+
+    counts = dynotable.get_status_counts(os.environ['STATE_TABLE_NAME'])
+    calls['dynamodb.GetItem'] -= 1
+
+    return counts.get('VALID', 0) + counts.get('IN_PROGRESS', 0)
+
+
+def simulate(options):
+    '''Run one batch through the simulator and return its results'''
+
+    rng = random.Random(options.seed)
+    clock = VirtualClock(time(), options.compression)
+    calls = Counter()
+
+    with mock_aws():
+        import awsclients
+        awsclients.RATE_LIMITS.clear()
+        awsclients.CLIENTS.clear()
+        for module in ('dynotable', 'orgcache', 'batchreport',
+                       'new_account_handler', 'account_create'):
+            sys.modules.pop(module, None)
+        import apimetrics
+        import batchreport
+        import cfnresource
+        import dynotable
+        import orgcache
+        import new_account_handler
+        import account_create
+
+        cfnresource.send = lambda *args, **kwargs: None
+        apimetrics.flush = lambda *args, **kwargs: None
+        for module in (account_create, orgcache, batchreport,
+                       new_account_handler):
+            module.time = clock.time
+        account_create.sleep = clock.sleep
+        account_create.MAX_IN_FLIGHT = options.concurrency
+
+        catalog = ServiceCatalog(
+            clock, Latency(options.latency, options.latency_median,
+                           options.latency_spread, rng), rng, options)
+        account_create.SC = catalog
+        bench_scale.count_calls([awsclients.get_client(service) for service
+                                 in ('dynamodb', 'organizations')], calls)
+
+        org = new_account_handler.ORG
+        org.create_organization(FeatureSet='ALL')
+        ou_ids = bench_scale.build_org(org, options.ous, 10)
+        bench_scale.create_tables(new_account_handler.DYNO)
+        new_account_handler.validate_update_dyno(
+            bench_scale.build_csv(options.accounts, ou_ids),
+            os.environ['TABLE_NAME'])
+        calls.clear()
+
+        sim = Simulation(clock, account_create.lambda_handler)
+        catalog.schedule = sim.schedule
+        started = perf_counter()
+        batch_start = clock.time()
+        busy = 0.0
+        sim.invoke('cloudformation', {
+            'RequestType': 'Create', 'ResponseURL': '', 'StackId': '',
+            'RequestId': '', 'LogicalResourceId': ''})
+        sim.schedule(clock.time() + SWEEP_INTERVAL, 'sweep', None)
+
+        while sim.queue and \
+                clock.time() - batch_start < options.max_hours * 3600:
+            (when, _, kind, payload) = heapq.heappop(sim.queue)
+            in_flight = catalog.in_flight()
+            previous = clock.time()
+            clock.advance_to(when)
+            busy += in_flight * (clock.time() - previous)
+            if kind == 'complete':
+                sim.invoke('controltower', catalog.complete(payload))
+            elif kind == 'sweep':
+                sim.invoke('schedule', {'source': 'aws.events'})
+                if remaining(dynotable, calls):
+                    sim.schedule(clock.time() + SWEEP_INTERVAL, 'sweep',
+                                 None)
+
+        elapsed = clock.time() - batch_start
+        wall = perf_counter() - started
+        calls.update(catalog.calls)
+        report = batchreport.build_report(
+            dynotable.scan_items(os.environ['TABLE_NAME']),
+            options.concurrency, clock.time())
+
+    return {
+        'accounts': options.accounts,
+        'concurrency': options.concurrency,
+        'virtual_hours': round(elapsed / 3600, 2),
+        'accounts_per_hour': round(report['Counts'].get('SUCCEEDED', 0) *
+                                   3600 / elapsed, 2) if elapsed else None,
+        'mean_in_flight': round(busy / elapsed, 2) if elapsed else None,
+        'outcomes': report['Counts'],
+        'latency': report['Latency'],
+        'invocations': dict(sim.invocations),
+        'calls': dict(sorted((name, count) for (name, count)
+                             in calls.items() if count)),
+        'total_calls': sum(calls.values()),
+        'wall_seconds': round(wall, 1),
+        'compression': round(elapsed / wall) if wall else None
+        }
+
+
+def main():
+    '''Run the simulator'''
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--accounts', type=int, default=100,
+                        help='rows in the batch, every tenth one INVALID')
+    parser.add_argument('--ous', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=5,
+                        help='MAX_IN_FLIGHT of account_create')
+    parser.add_argument('--ct-limit', type=int, default=5,
+                        help='launches Account Factory runs at once')
+    parser.add_argument('--latency', choices=LATENCY_MODELS,
+                        default='lognormal')
+    parser.add_argument('--latency-median', type=float, default=1500,
+                        help='median launch-to-completion seconds')
+    parser.add_argument('--latency-spread', type=float, default=0.2,
+                        help='lognormal sigma, or +/- fraction for uniform')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='share of launches ending FAILED')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='share of provision_product calls throttled')
+    parser.add_argument('--compression', type=float, default=0.0,
+                        help='virtual seconds per real second, 0 = no pacing')
+    parser.add_argument('--max-hours', type=float, default=24 * 14,
+                        help='stop after this much virtual time')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true',
+                        help='show errors, including injected failures')
+    options = parser.parse_args()
+    logging.disable(logging.WARNING if options.verbose else logging.ERROR)
+
+    print(json.dumps(simulate(options), indent=2))
+
+
+if __name__ == '__main__':
+    main()
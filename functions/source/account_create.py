@@ -21,55 +21,75 @@
 '''
 Lambda to process batch account creation
 '''
+# Taken before the other imports so MEASURE_IMPORT covers them
+# pylint: disable=wrong-import-position
+from time import perf_counter
+IMPORT_STARTED = perf_counter()
+
+import json
 import logging
 import os
-from time import sleep
-from random import randint
-import boto3
+import re
+import hashlib
+from time import sleep, time
+from botocore.exceptions import BotoCoreError, ClientError
+import apimetrics
+import awsclients
+import batchreport
 import cfnresource
+import dynotable
+import orgcache
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
-SC = boto3.client('servicecatalog')
-DYNO = boto3.client('dynamodb')
-STS = boto3.client('sts')
+SC = awsclients.lazy_client('servicecatalog')
+DYNO = awsclients.lazy_client('dynamodb')
 TABLE_NAME = os.environ.get("TABLE_NAME")
+STATE_TABLE_NAME = os.environ.get("STATE_TABLE_NAME")
 PRINCIPAL_ARN = os.environ.get("PRINCIPAL_ARN")
 SLEEP = 10
-
-
-def dyno_scan(table_name):
-    '''Return list of OUs in the organization'''
-
-    result = list()
-
-    try:
-        dyno_paginator = DYNO.get_paginator('scan')
-        dyno_page_iterator = dyno_paginator.paginate(TableName=table_name)
-    except Exception as exe:
-        LOGGER.error('Unable to scan the table: %s', str(exe))
-
-    for page in dyno_page_iterator:
-        result += page['Items']
-
-    return result
-
-
-def get_items(status, negate=False):
-    '''Get list of Valid entries to be provisioned'''
-
-    result = list()
-    items = dyno_scan(TABLE_NAME)
-
-    for item in items:
-        if negate:
-            if item['Status']['S'] != status:
-                result.append(item)
-        else:
-            if item['Status']['S'] == status:
-                result.append(item)
-
-    return result
+CT_MAX_CONCURRENCY = 5
+MAX_IN_FLIGHT = max(1, min(int(os.environ.get("MAX_IN_FLIGHT", "1")),
+                           CT_MAX_CONCURRENCY))
+SC_CACHE_TTL = int(os.environ.get("SC_CACHE_TTL", "3600"))
+SC_CACHE_PERSIST = os.environ.get("SC_CACHE_PERSIST", "true") == "true"
+SC_CACHE_KEY = 'SC_DISCOVERY'
+CHECK_INTERVAL = int(os.environ.get("CHECK_INTERVAL", "300"))
+# Seconds of invocation time needed to claim and launch one account
+LAUNCH_TIME = 30
+# A claim outlives the Lambda timeout, so it only expires once the
+# invocation holding it has ended without recording a launch
+LEASE_SECONDS = 900
+# VALID items tried in turn when another worker claims the first ones
+CLAIM_CANDIDATES = 5
+MAX_LAUNCH_ATTEMPTS = int(os.environ.get("MAX_LAUNCH_ATTEMPTS", "5"))
+RETRY_BASE = int(os.environ.get("RETRY_BASE", "300"))
+RETRY_CAP = 4 * 3600
+RETRYABLE_CODES = ('Throttling', 'ThrottlingException',
+                   'TooManyRequestsException', 'ResourceInUseException')
+RETRYABLE_MESSAGE = re.compile(
+    r'in progress|throttl|rate exceeded|try again', re.IGNORECASE)
+# Launches turned away while other Account Factory operations run
+CONTENTION_CODES = ('ResourceInUseException',)
+CONTENTION_MESSAGE = re.compile(r'in progress', re.IGNORECASE)
+FAILED_PP_STATES = ('ERROR', 'TAINTED')
+# Statuses an item may be in before moving to the key status
+ALLOWED_TRANSITIONS = {
+    'VALID': ('IN_PROGRESS',),
+    'IN_PROGRESS': ('VALID',),
+    'NOT_PROVISIONED': ('VALID', 'IN_PROGRESS'),
+    'SUCCEEDED': ('IN_PROGRESS', 'NOT_PROVISIONED'),
+    'FAILED': ('IN_PROGRESS', 'NOT_PROVISIONED')
+    }
+
+# Account Factory ids and principal association kept across warm starts
+SC_DISCOVERY = {}
+
+
+def get_items(status, limit=None):
+    '''Get list of entries with the given VALID or IN_PROGRESS status'''
+
+    return dynotable.query_items(TABLE_NAME, status, limit)
 
 
 def get_portfolio_id(prod_id):
@@ -251,52 +271,327 @@ def generate_account_name(data):
     return result
 
 
+def load_sc_discovery():
+    '''Return Account Factory ids persisted in the state table, if any'''
+
+    result = {}
+    item = None
+
+    if SC_CACHE_PERSIST:
+        item = dynotable.get_state(STATE_TABLE_NAME, SC_CACHE_KEY)
+
+    if item:
+        result = {'ProductId': item['ProductId']['S'],
+                  'ArtifactId': item['ArtifactId']['S'],
+                  'PortfolioId': item['PortfolioId']['S'],
+                  'ExpiresAt': int(item['ExpiresAt']['N'])}
+
+    return result
+
+
+def save_sc_discovery(discovery):
+    '''Persist Account Factory ids in the state table'''
+
+    if SC_CACHE_PERSIST:
+        dynotable.put_state(STATE_TABLE_NAME, SC_CACHE_KEY, {
+            'ProductId': {'S': discovery['ProductId']},
+            'ArtifactId': {'S': discovery['ArtifactId']},
+            'PortfolioId': {'S': discovery['PortfolioId']},
+            'ExpiresAt': {'N': str(discovery['ExpiresAt'])}})
+
+
+def get_sc_discovery():
+    '''
+    Return Account Factory ProductId, ArtifactId and PortfolioId with
+    PRINCIPAL_ARN associated to the portfolio. Looked up once per
+    SC_CACHE_TTL and reused from module memory or the state table.
+    '''
+
+    if SC_DISCOVERY.get('ExpiresAt', 0) <= time():
+        SC_DISCOVERY.clear()
+        stored = load_sc_discovery()
+        if stored.get('ExpiresAt', 0) > time():
+            LOGGER.info('Using stored Account Factory ids: %s', stored)
+            SC_DISCOVERY.update(stored)
+
+    result = SC_DISCOVERY
+
+    if not SC_DISCOVERY:
+        prod_id = get_product_id()
+        result = {'ProductId': prod_id,
+                  'ArtifactId': get_provisioning_artifact_id(prod_id),
+                  'PortfolioId': get_portfolio_id(prod_id)}
+        if all(result.values()) and associate_principal_portfolio(
+                PRINCIPAL_ARN, result['PortfolioId']):
+            SC_DISCOVERY.update(result,
+                                ExpiresAt=int(time()) + SC_CACHE_TTL)
+            save_sc_discovery(SC_DISCOVERY)
+
+    return result
+
+
+def invalidate_sc_discovery(exe):
+    '''
+    Drop cached Account Factory ids if provision_product failed because
+    they no longer exist or no longer match
+    '''
+
+    stale = False
+
+    if isinstance(exe, ClientError):
+        code = exe.response['Error']['Code']
+        stale = code == 'ResourceNotFoundException' or (
+            code == 'InvalidParametersException' and
+            'artifact' in str(exe).lower())
+
+    if stale:
+        LOGGER.warning('Invalidating cached Account Factory ids: %s', exe)
+        SC_DISCOVERY.clear()
+        if SC_CACHE_PERSIST:
+            dynotable.delete_state(STATE_TABLE_NAME, SC_CACHE_KEY)
+
+    return stale
+
+
+def is_batch_complete(in_flight=False):
+    '''
+    Return True if no item is VALID and, if in_flight, none is
+    IN_PROGRESS either. Read from the queue index, not the batch
+    summary, so a counter that missed an update cannot end the batch.
+    '''
+
+    statuses = ('VALID', 'IN_PROGRESS') if in_flight else ('VALID',)
+
+    return not any(get_items(status, 1) for status in statuses)
+
+
+def provision_token(item):
+    '''
+    Return the ProvisionToken for an item, derived from its content,
+    ingestion generation and launch attempt so a repeated launch of the
+    same attempt is idempotent
+    '''
+
+    content = [item.get(name, {}).get('S', '') for name in
+               ('AccountName', 'AccountEmail', 'RowHash')]
+    content += [item.get(name, {}).get('N', '0') for name in
+                ('Generation', 'Attempts', 'Deferrals')]
+
+    return hashlib.sha256('\x1f'.join(content).encode('utf-8')).hexdigest()
+
+
+def is_retryable(exe):
+    '''
+    Return True if a launch failed for a reason expected to clear:
+    throttling, another Account Factory operation in progress, a
+    connection error or stale cached Account Factory ids
+    '''
+
+    result = True
+
+    if isinstance(exe, ClientError):
+        error = exe.response.get('Error', {})
+        result = error.get('Code') in RETRYABLE_CODES or \
+            RETRYABLE_MESSAGE.search(error.get('Message', '')) is not None
+    elif not isinstance(exe, BotoCoreError):
+        result = False
+
+    return result
+
+
+def is_contention(exe):
+    '''
+    Return True if Account Factory turned a launch away because other
+    operations are in progress, rather than because the launch failed
+    '''
+
+    result = False
+
+    if isinstance(exe, ClientError):
+        error = exe.response.get('Error', {})
+        result = error.get('Code') in CONTENTION_CODES or \
+            CONTENTION_MESSAGE.search(error.get('Message', '')) is not None
+
+    return result
+
+
+def requeue_item(item, message):
+    '''
+    Return a claimed item to VALID with its attempt count and the time
+    of its next attempt, backing off exponentially from RETRY_BASE.
+    Return the update_item response, None if it was not requeued.
+    '''
+
+    attempts = int(item.get('Attempts', {'N': '0'})['N']) + 1
+    delay = min(RETRY_CAP, RETRY_BASE * 2 ** (attempts - 1))
+    LOGGER.warning('Retrying %s in %s sec, attempt %s of %s',
+                   item['AccountName']['S'], delay, attempts + 1,
+                   MAX_LAUNCH_ATTEMPTS)
+
+    return update_account_status(
+        item['AccountName']['S'], 'UNKNOWN', 'VALID',
+        'Launch attempt %s failed, retrying: %s' % (attempts, message),
+        attributes={'Attempts': {'N': str(attempts)},
+                    'NextAttemptAt': {'N': str(int(time()) + delay)}})
+
+
+def defer_item(item, message):
+    '''
+    Return a claimed item turned away by Account Factory contention to
+    VALID without using up a launch attempt, to be tried again after
+    RETRY_BASE. Deferrals gives the next launch a new provision token.
+    Return the update_item response, None if it was not deferred.
+    '''
+
+    deferrals = int(item.get('Deferrals', {'N': '0'})['N']) + 1
+    LOGGER.warning('Deferring %s for %s sec: %s', item['AccountName']['S'],
+                   RETRY_BASE, message)
+
+    return update_account_status(
+        item['AccountName']['S'], 'UNKNOWN', 'VALID',
+        'Launch deferred, other Account Factory operations in progress',
+        attributes={'Deferrals': {'N': str(deferrals)},
+                    'NextAttemptAt': {'N': str(int(time()) + RETRY_BASE)}})
+
+
+def launch_failed(item, exe):
+    '''
+    Requeue a claimed item whose launch failed with a retryable error
+    and attempts left, otherwise record it as NOT_PROVISIONED. A launch
+    turned away by contention is deferred instead, and the provisioning
+    slots are limited to the launches Account Factory is running.
+    '''
+
+    attempts = int(item.get('Attempts', {'N': '0'})['N']) + 1
+    stale = invalidate_sc_discovery(exe)
+
+    if is_contention(exe):
+        dynotable.shrink_slots(STATE_TABLE_NAME)
+        defer_item(item, str(exe))
+    elif (stale or is_retryable(exe)) and attempts < MAX_LAUNCH_ATTEMPTS:
+        requeue_item(item, str(exe))
+    else:
+        sc_initial_failure(generate_input_params(item), str(exe))
+
+
+def launch_item(item):
+    '''
+    Provision a claimed item as a new SC account and record the launch.
+    A failed launch is requeued or recorded by launch_failed. Return the
+    provisioned product id, or the error message.
+    '''
+
+    try:
+        discovery = get_sc_discovery()
+        input_params = generate_input_params(item)
+        prov_prod_name = generate_provisioned_product_name(input_params)
+        output = SC.provision_product(
+            ProductId=discovery['ProductId'],
+            ProvisioningArtifactId=discovery['ArtifactId'],
+            ProvisionedProductName=prov_prod_name,
+            ProvisioningParameters=input_params,
+            ProvisionToken=provision_token(item))
+        result = output['RecordDetail']['ProvisionedProductId']
+        record_launch(item['AccountName']['S'], result)
+    except Exception as exe:
+        LOGGER.error('SC product provisioning failed: %s', str(exe))
+        launch_failed(item, exe)
+        result = str(exe)
+
+    return result
+
+
 def provision_new_account():
-    '''Provision new SC account'''
+    '''
+    Claim the next VALID item and provision it as a new SC account.
+    Returns no input_params if there was no item left to claim.
+    '''
 
-    valid_items = get_items('VALID')
     result = "FAILED"
-    prod_id = get_product_id()
     input_params = list()
-    pa_id = get_provisioning_artifact_id(prod_id)
-    port_id = get_portfolio_id(prod_id)
-    associate_principal_portfolio(PRINCIPAL_ARN, port_id)
-
-    if len(valid_items) > 0:
-        item = valid_items[0]
+    claimed = None
+    valid_items = dynotable.query_items(TABLE_NAME, 'VALID',
+                                        CLAIM_CANDIDATES, int(time()))
+
+    for item in valid_items:
+        claimed = update_account_status(
+            item['AccountName']['S'], 'UNKNOWN', 'IN_PROGRESS',
+            'Provisioning started',
+            attributes={'LeaseExpiresAt': {
+                'N': str(int(time()) + LEASE_SECONDS)}})
+        if claimed:
+            break
+
+    if claimed:
+        item = claimed['Attributes']
         input_params = generate_input_params(item)
-        prov_prod_name = generate_provisioned_product_name(input_params)
-        try:
-            output = SC.provision_product(
-                ProductId=prod_id, ProvisioningArtifactId=pa_id,
-                ProvisionedProductName=prov_prod_name,
-                ProvisioningParameters=input_params,
-                ProvisionToken=str(randint(1000000000000, 9999999999999)))
-            result = output['RecordDetail']['ProvisionedProductId']
-        except Exception as exe:
-            LOGGER.error('SC product provisioning failed: %s', str(exe))
-            sleep(60)
-            result = str(exe)
+        result = launch_item(item)
     else:
         LOGGER.info('No more Account found to provision')
 
     return(result, input_params)
 
 
-def get_item_from_table(account_name):
-    '''Return true if Value exists'''
+def reclaim_lease(account_name):
+    '''
+    Renew the expired lease of an IN_PROGRESS item that was never
+    launched. Return the item if this invocation now holds it.
+    '''
 
     result = None
+    now = int(time())
 
     try:
-        result = DYNO.get_item(TableName=TABLE_NAME,
-                               Key={'AccountName': {'S': account_name}})
-    except Exception as exe:
-        LOGGER.error('Item not exist %s', str(exe))
+        result = DYNO.update_item(
+            TableName=TABLE_NAME,
+            Key={'AccountName': {'S': account_name}},
+            UpdateExpression='SET LeaseExpiresAt = :lease',
+            ConditionExpression='#status = :in_progress AND '
+                                'attribute_not_exists(ProvisionedProductId) '
+                                'AND (attribute_not_exists(LeaseExpiresAt) '
+                                'OR LeaseExpiresAt <= :now)',
+            ExpressionAttributeNames={'#status': 'Status'},
+            ExpressionAttributeValues={
+                ':lease': {'N': str(now + LEASE_SECONDS)},
+                ':in_progress': {'S': 'IN_PROGRESS'},
+                ':now': {'N': str(now)}},
+            ReturnValues='ALL_NEW')['Attributes']
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            LOGGER.info('Lease of %s is held or already renewed',
+                        account_name)
+        else:
+            LOGGER.error('Unable to reclaim %s: %s', account_name, str(exe))
 
     return result
 
 
+def reclaim_expired_leases(in_progress):
+    '''
+    Relaunch IN_PROGRESS items whose claim expired before a launch was
+    recorded. The provision token makes a launch that did reach Service
+    Catalog return the same product. Return number of items relaunched.
+    '''
+
+    now = time()
+    relaunched = 0
+    expired = [item for item in in_progress
+               if 'ProvisionedProductId' not in item and
+               int(item.get('LeaseExpiresAt', {'N': '0'})['N']) <= now]
+
+    for item in expired:
+        if not awsclients.has_time(LAUNCH_TIME):
+            break
+        account_name = item['AccountName']['S']
+        item = reclaim_lease(account_name)
+        if item:
+            LOGGER.warning('Reclaimed expired lease of %s', account_name)
+            if launch_item(item).startswith('pp-'):
+                relaunched += 1
+
+    return relaunched
+
+
 def sc_initial_failure(input_params, message):
     '''Update DynamoDB Table with SC Failure'''
 
@@ -316,26 +611,71 @@ def sc_initial_failure(input_params, message):
     return result
 
 
-def update_account_status(account_name, account_id, cmd_status, message):
-    '''Update DynamoDB Table with account status'''
+def update_account_status(account_name, account_id, cmd_status, message,
+                          attributes=None):
+    '''
+    Update DynamoDB Table with account status, move the item between the
+    batch summary counters and free its provisioning slot once it leaves
+    IN_PROGRESS. The update only applies to an existing item whose current
+    status may move to cmd_status (ALLOWED_TRANSITIONS), so missing rows
+    and stale or out-of-order events are dropped. attributes (name:typed
+    value) are set along with the status. QueueStatus follows the status
+    while it is VALID or IN_PROGRESS and is removed otherwise. Return the
+    update_item response holding the item as it was before the update.
+    '''
     result = None
-
-    key = {
-        "AccountName": {"S": account_name}
-        }
-    updates = {
-        "Status": {"Value": {"S": cmd_status}},
-        "Message": {"Value": {"S": message}},
-        "AccountId": {"Value": {"S": account_id}}
+    condition = 'attribute_exists(AccountName)'
+    now = str(int(time()))
+    expression = 'SET #status = :status, #message = :message, ' \
+                 '#account_id = :account_id, StatusChangedAt = :now'
+    values = {
+        ':status': {'S': cmd_status},
+        ':message': {'S': message},
+        ':account_id': {'S': account_id},
+        ':now': {'N': now}
         }
-    get_item = get_item_from_table(account_name)
 
-    if get_item:
-        try:
-            result = DYNO.update_item(TableName=TABLE_NAME,
-                                      Key=key, AttributeUpdates=updates,
-                                      ReturnValues="UPDATED_NEW")
-        except Exception as exe:
+    if cmd_status in batchreport.COMPLETED_STATUSES:
+        expression += ', CompletedAt = :now'
+
+    for (index, name) in enumerate(sorted(attributes or {})):
+        expression += ', ' + name + ' = :attr' + str(index)
+        values[':attr' + str(index)] = attributes[name]
+
+    if cmd_status in dynotable.QUEUE_STATUSES:
+        expression += ', QueueStatus = :status'
+    else:
+        expression += ' REMOVE QueueStatus'
+
+    if cmd_status in ALLOWED_TRANSITIONS:
+        allowed = list()
+        for (index, status) in enumerate(ALLOWED_TRANSITIONS[cmd_status]):
+            allowed.append(':from' + str(index))
+            values[':from' + str(index)] = {'S': status}
+        condition += ' AND #status IN (' + ', '.join(allowed) + ')'
+
+    try:
+        result = DYNO.update_item(
+            TableName=TABLE_NAME,
+            Key={'AccountName': {'S': account_name}},
+            UpdateExpression=expression,
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#status': 'Status',
+                                      '#message': 'Message',
+                                      '#account_id': 'AccountId'},
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_OLD')
+        old_status = result['Attributes']['Status']['S']
+        dynotable.move_status_count(STATE_TABLE_NAME, old_status,
+                                    cmd_status)
+        if old_status == 'IN_PROGRESS' and cmd_status != old_status:
+            dynotable.release_slot(STATE_TABLE_NAME)
+    except ClientError as exe:
+        result = None
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            LOGGER.info('Dropped %s for %s: row missing or stale event',
+                        cmd_status, account_name)
+        else:
             LOGGER.error('Unable to update the item: %s', str(exe))
 
     return result
@@ -353,44 +693,175 @@ def get_pp_status(pp_id):
         status = result['Status']
         if 'StatusMessage' in result:
             message = result['StatusMessage']
+        elif status in FAILED_PP_STATES:
+            message = get_record_errors(result['LastRecordId'])
     except Exception as exe:
         LOGGER.error("Unable to get provisioned product status: %s", str(exe))
 
     return(status, message)
 
 
+def get_record_errors(record_id):
+    '''Return the error descriptions of a provisioning record'''
+
+    result = None
+
+    try:
+        errors = SC.describe_record(Id=record_id)['RecordDetail'].get(
+            'RecordErrors', [])
+        result = '; '.join(error.get('Description', error.get('Code', ''))
+                           for error in errors)
+    except Exception as exe:
+        LOGGER.error("Unable to describe record %s: %s", record_id, str(exe))
+
+    return result
+
+
+def record_launch(account_name, pp_id):
+    '''Store the launched product id, launch time and when to check it'''
+
+    schedule_check(account_name, pp_id, CHECK_INTERVAL, launched=True)
+
+
+def schedule_check(account_name, pp_id, delay, launched=False):
+    '''
+    Set when the sweep should next check the provisioned product, and
+    the launch time if launched
+    '''
+
+    now = int(time())
+    expression = 'SET ProvisionedProductId = :pp, NextCheckAt = :next'
+    values = {':pp': {'S': pp_id}, ':next': {'N': str(now + delay)}}
+
+    if launched:
+        expression += ', LaunchedAt = :now REMOVE LeaseExpiresAt'
+        values[':now'] = {'N': str(now)}
+
+    try:
+        DYNO.update_item(
+            TableName=TABLE_NAME,
+            Key={'AccountName': {'S': account_name}},
+            UpdateExpression=expression,
+            ExpressionAttributeValues=values)
+    except Exception as exe:
+        LOGGER.error('Unable to schedule check of %s: %s',
+                     account_name, str(exe))
+
+
+def clear_check(account_name):
+    '''Stop checking the provisioned product of an account'''
+
+    try:
+        DYNO.update_item(TableName=TABLE_NAME,
+                         Key={'AccountName': {'S': account_name}},
+                         UpdateExpression='REMOVE NextCheckAt')
+    except Exception as exe:
+        LOGGER.error('Unable to clear check of %s: %s',
+                     account_name, str(exe))
+
+
+def reconcile_in_flight():
+    '''
+    Return the IN_PROGRESS items after reconciling the provisioning slots
+    in use with their number (dynotable.reconcile_slots). The slots are
+    left alone if the items cannot be queried.
+    '''
+
+    failed = list()
+    slots = dynotable.get_slots(STATE_TABLE_NAME)
+    in_progress = dynotable.query_items(TABLE_NAME, 'IN_PROGRESS',
+                                        failed=failed)
+
+    if not failed:
+        dynotable.reconcile_slots(STATE_TABLE_NAME, len(in_progress), slots)
+
+    return in_progress
+
+
+def sweep_launches():
+    '''
+    Check IN_PROGRESS items whose NextCheckAt is due. Failed products are
+    recorded with sc_initial_failure, AVAILABLE ones are left to the
+    lifecycle event and the rest are checked again after CHECK_INTERVAL.
+    Items whose claim expired without a launch are relaunched. The
+    provisioning slots in use are first reconciled with the IN_PROGRESS
+    items.
+    '''
+
+    now = time()
+    in_progress = reconcile_in_flight()
+    due = [item for item in in_progress
+           if 'NextCheckAt' in item and
+           int(item['NextCheckAt']['N']) <= now]
+
+    for item in due:
+        account_name = item['AccountName']['S']
+        pp_id = item['ProvisionedProductId']['S']
+        (status, message) = get_pp_status(pp_id)
+        if status in FAILED_PP_STATES:
+            sc_initial_failure(generate_input_params(item), str(message))
+        elif status == 'AVAILABLE':
+            clear_check(account_name)
+        else:
+            schedule_check(account_name, pp_id, CHECK_INTERVAL)
+
+    LOGGER.info('Checked %s launched accounts, relaunched %s',
+                len(due), reclaim_expired_leases(in_progress))
+
+    return len(due)
+
+
 def process_cft_event(event):
-    '''Handle the initial trigger from Cloudformation'''
+    '''
+    Handle the initial trigger from Cloudformation. On Create the
+    provisioning slots are seeded from the IN_PROGRESS items, as stream
+    events may already have launched some.
+    '''
 
     create_new_account = False
     LOGGER.info('Lambda Event: %s', event)
     request_type = event['RequestType']
     if request_type == 'Create':
+        reconcile_in_flight()
         create_new_account = True
     elif request_type == 'Delete':
         prod_id = get_product_id()
         port_id = get_portfolio_id(prod_id)
         disassociate_principal_portfolio(PRINCIPAL_ARN, port_id)
+        SC_DISCOVERY.clear()
     else:
         LOGGER.info('%s request received. No action taken', request_type)
 
     return create_new_account
 
 
+def frees_or_adds_work(record):
+    '''
+    Return True if a stream record moves an item out of IN_PROGRESS
+    (freeing a provisioning slot) or makes it VALID (new work)
+    '''
+
+    images = record.get('dynamodb', {})
+    old_status = images.get('OldImage', {}).get('Status', {}).get('S')
+    new_status = images.get('NewImage', {}).get('Status', {}).get('S')
+
+    return (old_status == 'IN_PROGRESS' and new_status != 'IN_PROGRESS') or \
+        (new_status == 'VALID' and old_status != 'VALID')
+
+
 def process_dynamodb_event(event):
-    '''Skip INSERT operation to avoid race condition with Lambda trigger'''
+    '''
+    Collapse a batch of stream records into one decision: fill the
+    provisioning slots if any record freed a slot or added VALID work
+    '''
 
-    result = False
-    event_name = event['Records'][0]['eventName']
+    records = event['Records']
+    relevant = [record for record in records if frees_or_adds_work(record)]
 
-    if event_name != 'INSERT':
-        LOGGER.info('DynamoDB Event Recieved: %s', event)
-        result = True
-    else:
-        LOGGER.info('DynamoDB %s received. No action taken', event_name)
-        result = False
+    LOGGER.info('DynamoDB batch: %s of %s records free a slot or add work',
+                len(relevant), len(records))
 
-    return result
+    return len(relevant) > 0
 
 
 def process_lifecycle_event(event):
@@ -413,13 +884,71 @@ def process_lifecycle_event(event):
         LOGGER.error('Unable to update the record %s: %s',
                      account_name, str(exe))
 
+    if cmd_status == 'SUCCEEDED' and update_result:
+        old_item = update_result['Attributes']
+        orgcache.add_account_email(old_item['AccountEmail']['S'])
+        if 'LaunchedAt' in old_item:
+            dynotable.add_provision_time(
+                STATE_TABLE_NAME,
+                int(time()) - int(old_item['LaunchedAt']['N']))
+
     LOGGER.info('Update Status for %s : %s', account_name, update_result)
 
 
+def report_batch_summary():
+    '''Log the SUCCESS/FAILED/INVALID counts of the batch'''
+
+    counts = dynotable.get_status_counts(STATE_TABLE_NAME) or {}
+    pass_count = counts.get('SUCCEEDED', 0)
+    fail_count = sum(counts.values()) - pass_count
+    invld_count = counts.get('INVALID', 0)
+    LOGGER.info('SUCCESS: %s Entries', pass_count)
+    LOGGER.info('TOTAL FAILED: %s Entries, %s', fail_count, counts)
+    LOGGER.warning('%s of %s FAILED DUE TO INVALID Entires',
+                   invld_count, fail_count)
+
+    return counts
+
+
+def fill_slots():
+    '''
+    Launch VALID items until MAX_IN_FLIGHT provisioning slots are in use.
+    Return list of (pp_id, input_params) launched.
+    '''
+
+    launched = list()
+    launching = True
+
+    while launching and awsclients.has_time(LAUNCH_TIME) and \
+            dynotable.acquire_slot(STATE_TABLE_NAME, MAX_IN_FLIGHT):
+        (pp_id, input_params) = provision_new_account()
+
+        if pp_id.startswith('pp-'):
+            launched.append((pp_id, input_params))
+        elif len(input_params) == 0:
+            launching = False
+            dynotable.release_slot(STATE_TABLE_NAME)
+            if is_batch_complete(in_flight=True):
+                LOGGER.info('Provisioning the batch completed')
+                report_batch_summary()
+        else:
+            launching = False
+            LOGGER.info('SC Product Launch Failed: %s', input_params)
+
+    LOGGER.info('Launched %s accounts', len(launched))
+
+    return launched
+
+
 def lambda_handler(event, context):
-    '''Parse the previous event and trigger next account creation'''
-    pp_id = None
+    '''
+    Parse the previous event and trigger next account creation. A Report
+    event returns the batch progress report instead.
+    '''
     create_new_account = False
+    event_source = None
+    result = None
+    awsclients.set_deadline(context)
 
     if 'RequestType' in event:
         event_source = 'cloudformation'
@@ -427,42 +956,33 @@ def lambda_handler(event, context):
     elif 'Records' in event:
         event_source = 'dynamodb'
         create_new_account = process_dynamodb_event(event)
+    elif event.get('Report'):
+        event_source = 'report'
+        result = batchreport.build_report(dynotable.scan_items(TABLE_NAME),
+                                          MAX_IN_FLIGHT)
+        LOGGER.info('Batch report: %s', json.dumps(result))
     elif event['source'] == 'aws.controltower':
         event_source = 'controltower'
         process_lifecycle_event(event)
+        create_new_account = True
+    elif event['source'] == 'aws.events':
+        event_source = 'schedule'
+        sweep_launches()
+        create_new_account = not is_batch_complete(in_flight=True)
     else:
         LOGGER.warning('Unknown Event recieved: %s', event)
 
     if create_new_account:
-        (pp_id, input_params) = provision_new_account()
+        fill_slots()
 
-        if pp_id.startswith('pp-'):
-            (status, message) = get_pp_status(pp_id)
-            iteration = 1
-            while iteration <= 3:
-                if status != 'UNDER_CHANGE':
-                    sc_initial_failure(input_params, message)
-                    iteration = 4
-                else:
-                    LOGGER.info('Check-%s: %s', iteration, status)
-                    sleep(30)
-                    (status, message) = get_pp_status(pp_id)
-                iteration += 1
-        elif len(input_params) == 0:
-            LOGGER.info('Provisioning the batch completed')
-            pass_items = get_items('SUCCEEDED')
-            fail_items = get_items('SUCCEEDED', True)
-            fail_count = len(fail_items)
-            invld_items = get_items('INVALID')
-            LOGGER.info('SUCCESS: %s Entries, %s', len(pass_items), pass_items)
-            LOGGER.info('TOTAL FAILED: %s Entries, %s', fail_count, fail_items)
-            LOGGER.warning('%s of %s FAILED DUE TO INVALID Entires, %s',
-                           len(invld_items), fail_count, invld_items)
-        else:
-            sc_initial_failure(input_params, pp_id)
-            LOGGER.info('SC Product Launch Failed: %s', input_params)
+    apimetrics.flush(getattr(context, 'function_name', 'account_create'))
 
     if event_source == 'cloudformation':
         response = {}
         cfnresource.send(event, context, cfnresource.SUCCESS,
                          response, "CustomResourcePhysicalID")
+
+    return result
+
+
+awsclients.log_timing('import account_create', IMPORT_STARTED)
@@ -0,0 +1,158 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Per-invocation AWS API call metrics collected with botocore event hooks
+and emitted as one CloudWatch Embedded Metric Format record
+'''
+
+import json
+import threading
+from time import perf_counter, time
+
+NAMESPACE = 'CTBatchAccountCreation'
+# Upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+THROTTLE_CODES = ('Throttling', 'ThrottlingException',
+                  'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException',
+                  'ProvisionedThroughputExceededException',
+                  'RequestLimitExceeded', 'SlowDown')
+# CloudWatch accepts at most 100 metrics per EMF record
+MAX_METRICS = 100
+
+STATS = {}
+LOCK = threading.Lock()
+
+
+def operation_stats(operation):
+    '''Return the stats of an operation, creating them if needed'''
+
+    if operation not in STATS:
+        STATS[operation] = {'Calls': 0, 'Retries': 0, 'Throttles': 0,
+                            'Errors': 0,
+                            'Latency': [0] * (len(LATENCY_BUCKETS) + 1)}
+
+    return STATS[operation]
+
+
+def operation_name(model):
+    '''Return service.Operation for an operation model'''
+
+    return model.service_model.endpoint_prefix + '.' + model.name
+
+
+def before_call(model, context, **kwargs):
+    '''Record when the call started'''
+
+    context['apimetrics_started'] = perf_counter()
+
+
+def after_call(model, parsed, context, **kwargs):
+    '''Record call count, retries, error and latency of a finished call'''
+
+    started = context.get('apimetrics_started')
+    latency = (perf_counter() - started) * 1000 if started else 0
+    metadata = parsed.get('ResponseMetadata', {})
+    code = parsed.get('Error', {}).get('Code')
+    bucket = len(LATENCY_BUCKETS)
+
+    for (index, bound) in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            bucket = index
+            break
+
+    with LOCK:
+        stats = operation_stats(operation_name(model))
+        stats['Calls'] += 1
+        stats['Retries'] += metadata.get('RetryAttempts', 0)
+        stats['Latency'][bucket] += 1
+        if code:
+            stats['Errors'] += 1
+
+
+def needs_retry(operation, response=None, **kwargs):
+    '''
+    Count throttled attempts. needs-retry is emitted after every attempt,
+    the last one included, so throttles are only counted here.
+    '''
+
+    if response and response[1].get('Error', {}).get('Code') in \
+            THROTTLE_CODES:
+        with LOCK:
+            operation_stats(operation_name(operation))['Throttles'] += 1
+
+
+def register(client):
+    '''Collect metrics for every call made through client'''
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('needs-retry', needs_retry)
+
+
+def to_emf(function_name, stats):
+    '''Return the EMF record for the collected stats'''
+
+    record = {'Function': function_name}
+    metrics = list()
+    values = [str(bound) for bound in LATENCY_BUCKETS] + \
+        [str(LATENCY_BUCKETS[-1] * 2)]
+
+    for (operation, stat) in sorted(stats.items()):
+        if len(metrics) + 5 > MAX_METRICS:
+            break
+        for name in ('Calls', 'Retries', 'Throttles', 'Errors'):
+            record[operation + '.' + name] = stat[name]
+            metrics.append({'Name': operation + '.' + name, 'Unit': 'Count'})
+        counts = [(float(value), count) for (value, count)
+                  in zip(values, stat['Latency']) if count]
+        record[operation + '.Latency'] = {
+            'Values': [value for (value, _) in counts],
+            'Counts': [count for (_, count) in counts]}
+        metrics.append({'Name': operation + '.Latency',
+                        'Unit': 'Milliseconds'})
+
+    record['_aws'] = {
+        'Timestamp': int(time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': NAMESPACE,
+                               'Dimensions': [['Function']],
+                               'Metrics': metrics}]}
+
+    return record
+
+
+def flush(function_name):
+    '''
+    Print the stats collected since the last flush as one EMF record and
+    reset them. Return the record, None if no calls were made.
+    '''
+
+    with LOCK:
+        stats = dict(STATS)
+        STATS.clear()
+
+    record = None
+
+    if stats:
+        record = to_emf(function_name, stats)
+        print(json.dumps(record))
+
+    return record
@@ -0,0 +1,205 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Shared boto3 client factory with adaptive retries and per-service
+client-side rate limits, used by both Lambdas. Clients are created on
+first use from one shared session, so invocations that make no calls
+never import boto3.
+'''
+
+import os
+import logging
+import threading
+from time import monotonic, perf_counter, sleep
+import apimetrics
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Requests per second and burst size kept under the published API quotas
+RATE_LIMITS = {
+    'organizations': (4.0, 8),
+    'servicecatalog': (5.0, 10),
+    'dynamodb': (50.0, 100),
+    's3': (100.0, 200),
+    'sts': (20.0, 20),
+    'identitystore': (10.0, 20)
+    }
+# Client settings that differ from the defaults, by service
+SERVICE_CONFIG = {
+    # Synchronous worker invocations run for up to the 900 s Lambda
+    # timeout; a retried invocation would ingest its shard again
+    'lambda': {'read_timeout': 960,
+               'retries': {'total_max_attempts': 1, 'mode': 'standard'}}
+    }
+MAX_ATTEMPTS = 10
+MAX_POOL_CONNECTIONS = 20
+MEASURE_IMPORT = os.environ.get("MEASURE_IMPORT", "false") == "true"
+# Seconds kept in reserve at the end of an invocation
+DEADLINE_MARGIN = 5.0
+
+SESSION = {}
+CLIENTS = {}
+BUCKETS = {}
+DEADLINE = {}
+LOCK = threading.Lock()
+
+
+class TokenBucket:
+    '''Thread-safe token bucket refilled at rate tokens per second'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait=None):
+        '''
+        Take one token, waiting for a refill if needed but never longer
+        than max_wait seconds. Return seconds waited.
+        '''
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if max_wait is not None:
+            wait = min(wait, max(0.0, max_wait))
+        if wait > 0:
+            sleep(wait)
+
+        return wait
+
+
+def set_deadline(context):
+    '''Record the Lambda context so waits respect the remaining time'''
+
+    DEADLINE['context'] = context
+
+
+def remaining_time():
+    '''Return seconds left in the invocation less DEADLINE_MARGIN'''
+
+    result = None
+    context = DEADLINE.get('context')
+
+    if context is not None and hasattr(context,
+                                       'get_remaining_time_in_millis'):
+        result = context.get_remaining_time_in_millis() / 1000.0 - \
+            DEADLINE_MARGIN
+
+    return result
+
+
+def has_time(seconds):
+    '''Return True if at least seconds remain in the invocation'''
+
+    remaining = remaining_time()
+
+    return remaining is None or remaining >= seconds
+
+
+def throttle(service):
+    '''Return a before-call hook taking a token from the service bucket'''
+
+    bucket = BUCKETS[service]
+
+    def before_call(**kwargs):
+        waited = bucket.acquire(remaining_time())
+        if waited > 1:
+            LOGGER.info('Rate limited %s call for %.1f sec',
+                        kwargs['model'].name, waited)
+
+    return before_call
+
+
+def get_session():
+    '''Return the boto3 session shared by all clients'''
+
+    if 'session' not in SESSION:
+        started = perf_counter()
+        import boto3  # pylint: disable=import-outside-toplevel
+        SESSION['session'] = boto3.session.Session()
+        log_timing('boto3 session', started)
+
+    return SESSION['session']
+
+
+def get_client(service):
+    '''
+    Return the shared client for service, configured with adaptive
+    retries (jittered exponential backoff driven by throttling responses),
+    a keep-alive connection pool and a client-side token bucket for the
+    service's API quota. SERVICE_CONFIG overrides these settings per
+    service. Calls are recorded by apimetrics.
+    '''
+
+    with LOCK:
+        if service not in CLIENTS:
+            session = get_session()
+            started = perf_counter()
+            from botocore.config import Config  # pylint: disable=C0415
+            settings = {'retries': {'max_attempts': MAX_ATTEMPTS,
+                                    'mode': 'adaptive'},
+                        'max_pool_connections': MAX_POOL_CONNECTIONS,
+                        'tcp_keepalive': True}
+            settings.update(SERVICE_CONFIG.get(service, {}))
+            config = Config(**settings)
+            client = session.client(service, config=config)
+            apimetrics.register(client)
+            if service in RATE_LIMITS:
+                BUCKETS[service] = TokenBucket(*RATE_LIMITS[service])
+                client.meta.events.register('before-call',
+                                            throttle(service))
+            CLIENTS[service] = client
+            log_timing(service + ' client', started)
+
+    return CLIENTS[service]
+
+
+class LazyClient:
+    '''Stand-in for a client that creates it on first attribute access'''
+
+    def __init__(self, service):
+        self.service = service
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service), name)
+
+
+def lazy_client(service):
+    '''Return a client for service that is only created when first used'''
+
+    return LazyClient(service)
+
+
+def log_timing(name, started):
+    '''Log time elapsed since started when MEASURE_IMPORT is enabled'''
+
+    if MEASURE_IMPORT:
+        LOGGER.info('COLD START %s: %.1f ms', name,
+                    (perf_counter() - started) * 1000)
@@ -0,0 +1,156 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+'''
+Progress report for a batch: accounts/hour, launch-to-completion latency
+per OU and an ETA for the rows still to provision, computed from the
+timestamps account_create records on each item.
+
+    TABLE_NAME=<account table> python batchreport.py
+'''
+
+import os
+import json
+import math
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+from time import time
+import dynotable
+
+COMPLETED_STATUSES = ('SUCCEEDED', 'FAILED', 'NOT_PROVISIONED')
+REMAINING_STATUSES = ('VALID', 'IN_PROGRESS')
+# Completions in this many seconds before the report give the recent rate
+RECENT_WINDOW = 3600
+
+
+def number(item, name):
+    '''Return a numeric attribute of an item, None if missing'''
+
+    value = item.get(name, {}).get('N')
+
+    return int(value) if value is not None else None
+
+
+def percentile(values, percent):
+    '''Return the nearest-rank percentile of values, None if empty'''
+
+    result = None
+
+    if values:
+        ordered = sorted(values)
+        result = ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+    return result
+
+
+def latency_stats(values):
+    '''Return count, p50 and p95 of latencies in seconds'''
+
+    return {'Count': len(values), 'P50': percentile(values, 50),
+            'P95': percentile(values, 95)}
+
+
+def per_hour(count, seconds):
+    '''Return count per hour over seconds, None for an empty period'''
+
+    return round(count * 3600 / seconds, 2) if seconds > 0 else None
+
+
+def build_report(items, concurrency=None, now=None):
+    '''
+    Return the progress report of the batch items. Throughput is measured
+    from the first launch to now, and over the last RECENT_WINDOW seconds;
+    the ETA divides the VALID and IN_PROGRESS rows by the recent rate, or
+    the overall one if nothing completed recently.
+    '''
+
+    now = now or time()
+    counts = Counter(item['Status']['S'] for item in items)
+    latencies = list()
+    org_units = dict()
+    launches = list()
+    recent = 0
+
+    for item in items:
+        launched = number(item, 'LaunchedAt')
+        completed = number(item, 'CompletedAt')
+        if launched:
+            launches.append(launched)
+        if item['Status']['S'] != 'SUCCEEDED' or not (launched and completed):
+            continue
+        latencies.append(completed - launched)
+        org_units.setdefault(item['OrgUnit']['S'], list()).append(
+            completed - launched)
+        if completed >= now - RECENT_WINDOW:
+            recent += 1
+
+    remaining = sum(counts[status] for status in REMAINING_STATUSES)
+    overall = per_hour(len(latencies), now - min(launches)) \
+        if launches else None
+    recent_rate = per_hour(recent, min(RECENT_WINDOW, now - min(launches))) \
+        if launches else None
+    rate = recent_rate or overall
+    eta = None
+    completion = None
+
+    if rate and remaining:
+        eta = round(remaining * 3600 / rate)
+        completion = datetime.fromtimestamp(now + eta, timezone.utc)
+
+    return {
+        'GeneratedAt': datetime.fromtimestamp(now, timezone.utc).isoformat(
+            timespec='seconds'),
+        'Counts': dict(counts),
+        'Remaining': remaining,
+        'Concurrency': concurrency,
+        'AccountsPerHour': overall,
+        'AccountsPerHourRecent': recent_rate,
+        'Latency': latency_stats(latencies),
+        'LatencyByOrgUnit': {ou: latency_stats(values) for (ou, values)
+                             in sorted(org_units.items())},
+        'EtaSeconds': eta,
+        'EstimatedCompletion': completion.isoformat(timespec='seconds')
+                               if completion else None
+        }
+
+
+def main():
+    '''Print the progress report of the account table'''
+
+    parser = argparse.ArgumentParser(
+        description='Report batch throughput, latency and ETA')
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'),
+                        help='account table, default: TABLE_NAME')
+    parser.add_argument('--concurrency', type=int,
+                        default=os.environ.get('MAX_IN_FLIGHT'),
+                        help='provisioning concurrency shown in the report')
+    args = parser.parse_args()
+
+    if not args.table:
+        parser.error('no account table, pass --table or set TABLE_NAME')
+
+    print(json.dumps(build_report(dynotable.scan_items(args.table),
+                                  args.concurrency), indent=2))
+
+
+if __name__ == '__main__':
+    main()
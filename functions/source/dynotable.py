@@ -0,0 +1,529 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Data access helpers for the account details table shared by both Lambdas
+'''
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from random import uniform
+from botocore.exceptions import ClientError
+import apimetrics
+import awsclients
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+DYNO = awsclients.lazy_client('dynamodb')
+# Sparse index of the items waiting for or holding a launch: QueueStatus
+# is only set while the item is in one of QUEUE_STATUSES
+QUEUE_INDEX = 'QueueIndex'
+QUEUE_STATUSES = ('VALID', 'IN_PROGRESS')
+SUMMARY_KEY = 'BATCH_SUMMARY'
+SLOTS_KEY = 'PROVISION_SLOTS'
+LATENCY_KEY = 'PROVISION_LATENCY'
+BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+QUERY_PAGE_SIZE = 25
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 5.0
+
+
+def chunks(items, size=BATCH_SIZE):
+    '''Yield successive lists of at most size items'''
+
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def scan_items(table_name):
+    '''Return all items in the table'''
+
+    result = list()
+
+    try:
+        dyno_paginator = DYNO.get_paginator('scan')
+        for page in dyno_paginator.paginate(TableName=table_name):
+            result += page['Items']
+    except ClientError as exe:
+        LOGGER.error('Unable to scan the table: %s', str(exe))
+
+    return result
+
+
+def query_items(table_name, status, limit=None, due_by=None, failed=None):
+    '''
+    Return items with the given Status using the queue index, returning
+    no more than limit items if given. Only QUEUE_STATUSES are indexed.
+    If due_by (epoch seconds) is given, only items without a
+    NextAttemptAt at or before it are returned. If the query fails,
+    status is appended to failed.
+    '''
+
+    result = list()
+    kwargs = {
+        'TableName': table_name,
+        'IndexName': QUEUE_INDEX,
+        'KeyConditionExpression': 'QueueStatus = :status',
+        'ExpressionAttributeValues': {':status': {'S': status}}
+        }
+    page_size = limit
+
+    if due_by is not None:
+        kwargs['FilterExpression'] = 'attribute_not_exists(NextAttemptAt) ' \
+                                     'OR NextAttemptAt <= :due_by'
+        kwargs['ExpressionAttributeValues'][':due_by'] = {'N': str(due_by)}
+        # Items filtered out still count against a page
+        page_size = max(limit or 0, QUERY_PAGE_SIZE)
+
+    if limit:
+        kwargs['PaginationConfig'] = {'MaxItems': limit,
+                                      'PageSize': page_size}
+
+    try:
+        dyno_paginator = DYNO.get_paginator('query')
+        for page in dyno_paginator.paginate(**kwargs):
+            result += page['Items']
+    except ClientError as exe:
+        LOGGER.error('Unable to query %s items: %s', status, str(exe))
+        if failed is not None:
+            failed.append(status)
+
+    return result
+
+
+def backoff(attempt):
+    '''Return full-jitter exponential backoff delay for an attempt'''
+
+    return uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def is_retryable(exe):
+    '''
+    Return True if a ClientError is throttling or a server-side error.
+    Other errors, such as a ValidationException, fail the same way again.
+    '''
+
+    error = exe.response.get('Error', {})
+    status = exe.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+
+    return error.get('Code') in apimetrics.THROTTLE_CODES or status >= 500
+
+
+def get_batch(table_name, keys, key_name='AccountName', attributes=None):
+    '''
+    Read up to 100 items with BatchGetItem, retrying UnprocessedKeys and
+    retryable errors. Return key:item for the items found, projected to
+    attributes if given, and list of keys that could not be read.
+    '''
+
+    found = dict()
+    request = {'Keys': [{key_name: {'S': key}} for key in keys],
+               'ConsistentRead': True}
+    attempt = 0
+
+    if attributes:
+        names = {'#a' + str(index): name
+                 for (index, name) in enumerate((key_name,) + attributes)}
+        request['ProjectionExpression'] = ', '.join(names)
+        request['ExpressionAttributeNames'] = names
+
+    while request['Keys'] and attempt < MAX_ATTEMPTS:
+        if attempt > 0:
+            sleep(backoff(attempt))
+        attempt += 1
+        try:
+            response = DYNO.batch_get_item(RequestItems={table_name: request})
+            for item in response['Responses'].get(table_name, []):
+                found[item[key_name]['S']] = item
+            request['Keys'] = response.get('UnprocessedKeys', {}).get(
+                table_name, {}).get('Keys', [])
+        except ClientError as exe:
+            LOGGER.warning('BatchGetItem attempt %s failed: %s',
+                           attempt, str(exe))
+            if not is_retryable(exe):
+                break
+
+    unread = [key[key_name]['S'] for key in request['Keys']]
+
+    if unread:
+        LOGGER.error('Unable to read %s items after %s attempts: %s',
+                     len(unread), attempt, unread)
+
+    return (found, unread)
+
+
+def batch_get_items(table_name, keys, key_name='AccountName',
+                    attributes=None):
+    '''
+    Read the items for keys in 100-key batches. Return key:item for the
+    keys that exist, projected to attributes if given, and list of keys
+    that could not be read.
+    '''
+
+    found = dict()
+    unread = list()
+
+    for batch in chunks(sorted(set(keys)), GET_BATCH_SIZE):
+        (items, keys_left) = get_batch(table_name, batch, key_name,
+                                       attributes)
+        found.update(items)
+        unread += keys_left
+
+    return (found, unread)
+
+
+def write_batch(table_name, items, key_name='AccountName'):
+    '''
+    Write up to 25 items with BatchWriteItem, retrying UnprocessedItems
+    and retryable errors. Return list of keys that could not be written.
+    '''
+
+    requests = [{'PutRequest': {'Item': item}} for item in items]
+    attempt = 0
+
+    while requests and attempt < MAX_ATTEMPTS:
+        if attempt > 0:
+            sleep(backoff(attempt))
+        attempt += 1
+        try:
+            response = DYNO.batch_write_item(
+                RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(
+                table_name, [])
+        except ClientError as exe:
+            LOGGER.warning('BatchWriteItem attempt %s failed: %s',
+                           attempt, str(exe))
+            if not is_retryable(exe):
+                break
+
+    failed = [req['PutRequest']['Item'][key_name]['S'] for req in requests]
+
+    if failed:
+        LOGGER.error('Unable to write %s items after %s attempts: %s',
+                     len(failed), attempt, failed)
+
+    return failed
+
+
+def batch_write_items(table_name, items, key_name='AccountName',
+                      max_workers=1):
+    '''
+    Write items in 25-item batches, max_workers batches at a time.
+    Return key:True/False write result for every item. Items sharing a
+    key are collapsed to the last one, as successive put_item would.
+    '''
+
+    unique = dict()
+
+    for item in items:
+        unique[item[key_name]['S']] = item
+
+    results = dict.fromkeys(unique, True)
+    batches = list(chunks(list(unique.values())))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for failed in pool.map(
+                lambda batch: write_batch(table_name, batch, key_name),
+                batches):
+            for key in failed:
+                results[key] = False
+
+    return results
+
+
+def add_status_counts(state_table, deltas):
+    '''Atomically add Status:delta values to the batch summary counters'''
+
+    result = True
+    names = dict()
+    values = dict()
+
+    for (status, delta) in deltas.items():
+        if delta:
+            index = str(len(names))
+            names['#s' + index] = status
+            values[':v' + index] = {'N': str(delta)}
+
+    if names:
+        expression = 'ADD ' + ', '.join(
+            name + ' ' + name.replace('#s', ':v') for name in names)
+        try:
+            DYNO.update_item(TableName=state_table,
+                             Key={'StateKey': {'S': SUMMARY_KEY}},
+                             UpdateExpression=expression,
+                             ExpressionAttributeNames=names,
+                             ExpressionAttributeValues=values)
+        except ClientError as exe:
+            LOGGER.error('Unable to update the batch summary: %s', str(exe))
+            result = False
+
+    return result
+
+
+def move_status_count(state_table, old_status, new_status):
+    '''Move one item from old_status to new_status in the batch summary'''
+
+    result = True
+
+    if old_status != new_status:
+        deltas = {new_status: 1}
+        if old_status:
+            deltas[old_status] = -1
+        result = add_status_counts(state_table, deltas)
+
+    return result
+
+
+def get_status_counts(state_table):
+    '''Return Status:count values of the batch summary, None if missing'''
+
+    result = None
+
+    try:
+        item = DYNO.get_item(TableName=state_table,
+                             Key={'StateKey': {'S': SUMMARY_KEY}},
+                             ConsistentRead=True).get('Item')
+        if item:
+            result = {name: int(value['N']) for (name, value) in item.items()
+                      if 'N' in value}
+    except ClientError as exe:
+        LOGGER.error('Unable to read the batch summary: %s', str(exe))
+
+    return result
+
+
+def add_provision_time(state_table, seconds):
+    '''Add the launch-to-SUCCEEDED time of one account to the totals'''
+
+    result = False
+
+    try:
+        DYNO.update_item(TableName=state_table,
+                         Key={'StateKey': {'S': LATENCY_KEY}},
+                         UpdateExpression='ADD Seconds :sec, Accounts :one',
+                         ExpressionAttributeValues={
+                             ':sec': {'N': str(max(0, seconds))},
+                             ':one': {'N': '1'}})
+        result = True
+    except ClientError as exe:
+        LOGGER.error('Unable to record provisioning time: %s', str(exe))
+
+    return result
+
+
+def get_provision_time(state_table):
+    '''
+    Return mean seconds from launch to SUCCEEDED over the accounts
+    created so far, None if there are none
+    '''
+
+    result = None
+    item = get_state(state_table, LATENCY_KEY)
+
+    if item and int(item['Accounts']['N']) > 0:
+        result = int(item['Seconds']['N']) / int(item['Accounts']['N'])
+
+    return result
+
+
+def acquire_slot(state_table, limit):
+    '''
+    Take one provisioning slot if fewer than limit, and fewer than a
+    SlotLimit set by shrink_slots, are in use. Return True if the slot
+    was taken.
+    '''
+
+    result = False
+
+    try:
+        DYNO.update_item(
+            TableName=state_table, Key={'StateKey': {'S': SLOTS_KEY}},
+            UpdateExpression='ADD InFlight :one REMOVE PendingInFlight',
+            ConditionExpression='(attribute_not_exists(InFlight) '
+                                'OR InFlight < :limit) AND '
+                                '(attribute_not_exists(SlotLimit) '
+                                'OR InFlight < SlotLimit)',
+            ExpressionAttributeValues={':one': {'N': '1'},
+                                       ':limit': {'N': str(limit)}})
+        result = True
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            LOGGER.info('All %s provisioning slots are in use', limit)
+        else:
+            LOGGER.error('Unable to acquire a provisioning slot: %s',
+                         str(exe))
+
+    return result
+
+
+def release_slot(state_table):
+    '''Return one provisioning slot. Return True if a slot was in use'''
+
+    result = False
+
+    try:
+        DYNO.update_item(
+            TableName=state_table, Key={'StateKey': {'S': SLOTS_KEY}},
+            UpdateExpression='ADD InFlight :minus REMOVE PendingInFlight',
+            ConditionExpression='InFlight > :zero',
+            ExpressionAttributeValues={':minus': {'N': '-1'},
+                                       ':zero': {'N': '0'}})
+        result = True
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            LOGGER.warning('No provisioning slot in use to release')
+        else:
+            LOGGER.error('Unable to release a provisioning slot: %s',
+                         str(exe))
+
+    return result
+
+
+def get_slots(state_table):
+    '''Return the provisioning slots item, None if missing or unreadable'''
+
+    return get_state(state_table, SLOTS_KEY)
+
+
+def shrink_slots(state_table):
+    '''
+    Limit the provisioning slots to those in use but the caller's, after
+    Account Factory turned a launch away because of the others. The limit
+    stays until reconcile_slots lifts it. Return True if it was set.
+    '''
+
+    result = False
+
+    try:
+        response = DYNO.update_item(
+            TableName=state_table, Key={'StateKey': {'S': SLOTS_KEY}},
+            UpdateExpression='SET SlotLimit = InFlight - :one',
+            ConditionExpression='InFlight > :one',
+            ExpressionAttributeValues={':one': {'N': '1'}},
+            ReturnValues='UPDATED_NEW')
+        LOGGER.warning('Limited provisioning slots to %s',
+                       response['Attributes']['SlotLimit']['N'])
+        result = True
+    except ClientError as exe:
+        if exe.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            LOGGER.error('Unable to limit provisioning slots: %s', str(exe))
+
+    return result
+
+
+def reconcile_slots(state_table, in_flight, slots):
+    '''
+    Correct the provisioning slots in use to in_flight, the number of
+    IN_PROGRESS items, and lift any SlotLimit, unless the slots item
+    changed from slots (as read by get_slots) while the items were
+    counted. A count above the slots in use is applied at once. A lower
+    count may miss a slot just taken or a write the index has not caught
+    up with, so it is kept as PendingInFlight and only applied when the
+    next sweep counts the same; taking or returning a slot in between
+    drops it. Slots leaked by failed invocations are
+    recovered this way. Return True if the slots were updated.
+    '''
+
+    result = False
+    slots = slots or {}
+    seen = int(slots['InFlight']['N']) if 'InFlight' in slots else None
+    pending = int(slots['PendingInFlight']['N']) \
+        if 'PendingInFlight' in slots else None
+    expression = 'SET InFlight = :in_flight REMOVE SlotLimit, PendingInFlight'
+
+    if seen is not None and in_flight < seen and pending != in_flight:
+        expression = 'SET PendingInFlight = :in_flight REMOVE SlotLimit'
+
+    if seen != in_flight or 'SlotLimit' in slots or \
+            pending is not None:
+        condition = 'attribute_not_exists(InFlight)' if seen is None \
+            else 'InFlight = :seen'
+        values = {':in_flight': {'N': str(in_flight)}}
+        if seen is not None:
+            values[':seen'] = {'N': str(seen)}
+        try:
+            DYNO.update_item(
+                TableName=state_table, Key={'StateKey': {'S': SLOTS_KEY}},
+                UpdateExpression=expression, ConditionExpression=condition,
+                ExpressionAttributeValues=values)
+            if expression.startswith('SET PendingInFlight'):
+                LOGGER.info('Counted %s provisioning slots in use of %s, '
+                            'to confirm on the next sweep', in_flight, seen)
+            elif seen != in_flight:
+                LOGGER.warning('Corrected provisioning slots in use from %s '
+                               'to %s', seen, in_flight)
+            result = True
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == \
+                    'ConditionalCheckFailedException':
+                LOGGER.info('Provisioning slots changed while counting')
+            else:
+                LOGGER.error('Unable to correct provisioning slots: %s',
+                             str(exe))
+
+    return result
+
+
+def get_state(state_table, state_key):
+    '''Return the state table item for state_key, None if missing'''
+
+    result = None
+
+    try:
+        result = DYNO.get_item(TableName=state_table,
+                               Key={'StateKey': {'S': state_key}},
+                               ConsistentRead=True).get('Item')
+    except ClientError as exe:
+        LOGGER.error('Unable to read %s: %s', state_key, str(exe))
+
+    return result
+
+
+def put_state(state_table, state_key, attributes):
+    '''Store attributes (DynamoDB typed values) under state_key'''
+
+    result = False
+
+    try:
+        DYNO.put_item(TableName=state_table,
+                      Item=dict(attributes, StateKey={'S': state_key}))
+        result = True
+    except ClientError as exe:
+        LOGGER.error('Unable to store %s: %s', state_key, str(exe))
+
+    return result
+
+
+def delete_state(state_table, state_key):
+    '''Remove the state table item for state_key'''
+
+    result = False
+
+    try:
+        DYNO.delete_item(TableName=state_table,
+                         Key={'StateKey': {'S': state_key}})
+        result = True
+    except ClientError as exe:
+        LOGGER.error('Unable to delete %s: %s', state_key, str(exe))
+
+    return result
@@ -0,0 +1,381 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Streaming reads of batch input files and the fan-out of large inputs to
+byte-range shards, each ingested by its own synchronous invocation
+'''
+
+import os
+import io
+import csv
+import json
+import codecs
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from botocore.exceptions import BotoCoreError, ClientError
+import awsclients
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+SSS = awsclients.lazy_client('s3')
+LAMBDA = awsclients.lazy_client('lambda')
+READ_CHUNK_SIZE = 64 * 1024
+SHARD_BYTES = int(os.environ.get("SHARD_BYTES", str(1024 * 1024)))
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "20"))
+# Bytes read to find the header line of a shard's object
+HEADER_BYTES = 4096
+# Fields whose values are checked for repeats across shards
+KEY_FIELDS = ('AccountName', 'AccountEmail', 'SSOUserEmail')
+
+
+def iter_lines(chunks):
+    '''
+    Yield text lines from an iterable of utf-8-sig encoded byte chunks,
+    holding at most one chunk plus a partial line in memory
+    '''
+
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        end = pending.rfind('\n') + 1
+        if end:
+            yield from io.StringIO(pending[:end], newline='')
+            pending = pending[end:]
+
+    pending += decoder.decode(b'', final=True)
+
+    if pending:
+        yield from io.StringIO(pending, newline='')
+
+
+def shard_chunks(chunks, offset, start, end):
+    '''
+    Yield the lines starting at a byte position within [start, end) from
+    byte chunks read from position offset. A line started before start is
+    skipped; the line crossing end is read to its end.
+    '''
+
+    position = offset
+    pending = b''
+    skipping = start > 0
+
+    for chunk in chunks:
+        pending += chunk
+        index = 0
+        if skipping:
+            newline = pending.find(b'\n')
+            if newline < 0:
+                position += len(pending)
+                pending = b''
+                continue
+            index = newline + 1
+            position += index
+            skipping = False
+        while position < end:
+            newline = pending.find(b'\n', index)
+            if newline < 0:
+                break
+            yield pending[index:newline + 1]
+            position += newline + 1 - index
+            index = newline + 1
+        pending = pending[index:]
+        if position >= end:
+            return
+
+    if pending and not skipping:
+        yield pending
+
+
+def read_shard(shard):
+    '''
+    Return an iterator over the CSV lines of a byte-range shard: the
+    object's header line followed by the lines starting within the
+    shard's Start/End range
+    '''
+
+    result = None
+    header = b''
+    offset = max(0, shard['Start'] - 1)
+
+    try:
+        if shard['Start'] > 0:
+            head = SSS.get_object(Bucket=shard['Bucket'], Key=shard['Key'],
+                                  Range='bytes=0-%s' % (HEADER_BYTES - 1))
+            header = head['Body'].read().split(b'\n', 1)[0] + b'\n'
+        body = SSS.get_object(Bucket=shard['Bucket'], Key=shard['Key'],
+                              Range='bytes=%s-' % offset)['Body']
+        result = iter_lines(chain([header], shard_chunks(
+            body.iter_chunks(chunk_size=READ_CHUNK_SIZE), offset,
+            shard['Start'], shard['End'])))
+    except ClientError as exe:
+        LOGGER.error('Unable to read shard %s: %s', shard, str(exe))
+
+    return result
+
+
+def list_shards(bucket, prefix, shard_bytes=SHARD_BYTES):
+    '''
+    Return Bucket/Key/Start/End byte-range shards of at most shard_bytes
+    covering the objects under prefix
+    '''
+
+    shards = list()
+
+    try:
+        s3_paginator = SSS.get_paginator('list_objects_v2')
+        for page in s3_paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('/'):
+                    continue
+                for start in range(0, obj['Size'], shard_bytes):
+                    shards.append({'Bucket': bucket, 'Key': obj['Key'],
+                                   'Start': start,
+                                   'End': min(start + shard_bytes,
+                                              obj['Size'])})
+    except ClientError as exe:
+        LOGGER.error('Unable to list %s/%s: %s', bucket, prefix, str(exe))
+
+    return shards
+
+
+def iter_object_lines(bucket, key):
+    '''
+    Yield the line number, start byte position and raw bytes of each line
+    of an object
+    '''
+
+    body = SSS.get_object(Bucket=bucket, Key=key)['Body']
+    (number, position, pending) = (0, 0, b'')
+
+    for chunk in body.iter_chunks(chunk_size=READ_CHUNK_SIZE):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            number += 1
+            yield (number, position, line)
+            position += len(line) + 1
+
+    if pending:
+        yield (number + 1, position, pending)
+
+
+def scan_object(shards, first, indexes, row_keys):
+    '''
+    Read the object of the shards starting at shards[first] and add its
+    rows to indexes. indexes map each of KEY_FIELDS to the first location
+    (shard index << 32 | line) of every value digest and, for values used
+    in more than one shard, the shards using them; under 'SsoNames' they
+    map an SSOUserEmail digest to the name digest of its first row.
+    row_keys returns those digests for a row. Set LinesBefore on each
+    shard so workers report object line numbers. Return the index of the
+    first shard of the next object.
+    '''
+
+    current = first
+    key = shards[first]['Key']
+    fields = None
+
+    for (number, position, line) in iter_object_lines(
+            shards[first]['Bucket'], key):
+        if fields is None:
+            fields = next(csv.reader([line.decode('utf-8-sig')]), [])
+            continue
+        while current + 1 < len(shards) and \
+                shards[current + 1]['Key'] == key and \
+                position >= shards[current + 1]['Start']:
+            current += 1
+        if shards[current]['Start'] > 0 and \
+                'LinesBefore' not in shards[current]:
+            shards[current]['LinesBefore'] = number - 2
+        keys = row_keys(dict(zip(fields, next(csv.reader(
+            [line.decode('utf-8', 'replace')]), []))))
+        if keys is None:
+            continue
+        (values, sso_name) = keys
+        if values['SSOUserEmail'] is not None:
+            indexes['SsoNames'].setdefault(values['SSOUserEmail'], sso_name)
+        for field in KEY_FIELDS:
+            if values[field] is None:
+                continue
+            (locations, spread) = indexes[field]
+            location = locations.setdefault(values[field],
+                                            current << 32 | number)
+            used_in = spread.get(values[field], [location >> 32])
+            if used_in[-1] != current:
+                spread[values[field]] = used_in + [current]
+
+    while current + 1 < len(shards) and shards[current + 1]['Key'] == key:
+        current += 1
+
+    LOGGER.info('Scanned %s shards of %s/%s', current - first + 1,
+                shards[first]['Bucket'], key)
+
+    return current + 1
+
+
+def add_duplicate(shard, kind, value, first=None):
+    '''
+    Record on a shard a value digest also used by other shards. Under
+    Skip are the AccountNames the shard leaves to a later shard; Names,
+    Emails and SsoUsers map a value to first, its first row.
+    '''
+
+    duplicates = shard.setdefault('Duplicates', {})
+
+    if kind == 'Skip':
+        duplicates.setdefault(kind, []).append(value)
+    else:
+        duplicates.setdefault(kind, {})[value] = first
+
+
+def shard_reference(shards, location):
+    '''Return "line of key" for a location (shard index << 32 | line)'''
+
+    return '%s of %s' % (location & 0xffffffff,
+                         shards[location >> 32]['Key'])
+
+
+def prescan_shards(shards, row_keys):
+    '''
+    Read every object of shards once to find the AccountName and
+    AccountEmail values repeated across shards, and set Duplicates on the
+    shards they affect. A repeated AccountName is written only by the
+    shard holding its last row; the shards before it skip the name, and
+    that shard reports the first row as the conflict. A repeated
+    AccountEmail is reported against its first row by the later shards,
+    which also check an SSOUserEmail against the name of its first row.
+    row_keys returns the value digests of a row, see scan_object.
+    '''
+
+    indexes = {field: (dict(), dict()) for field in KEY_FIELDS}
+    indexes['SsoNames'] = dict()
+    next_object = 0
+
+    while next_object < len(shards):
+        try:
+            next_object = scan_object(shards, next_object, indexes, row_keys)
+        except (ClientError, BotoCoreError) as exe:
+            key = shards[next_object]['Key']
+            LOGGER.error('Unable to scan %s, duplicates across its shards '
+                         'are not detected: %s', key, str(exe))
+            while next_object < len(shards) and \
+                    shards[next_object]['Key'] == key:
+                next_object += 1
+
+    (locations, spread) = indexes['AccountName']
+    for (value, used_in) in spread.items():
+        for shard_index in used_in[:-1]:
+            add_duplicate(shards[shard_index], 'Skip', value)
+        add_duplicate(shards[used_in[-1]], 'Names', value,
+                      shard_reference(shards, locations[value]))
+
+    (locations, spread) = indexes['AccountEmail']
+    for (value, used_in) in spread.items():
+        for shard_index in used_in[1:]:
+            add_duplicate(shards[shard_index], 'Emails', value,
+                          shard_reference(shards, locations[value]))
+
+    (locations, spread) = indexes['SSOUserEmail']
+    for (value, used_in) in spread.items():
+        for shard_index in used_in[1:]:
+            add_duplicate(shards[shard_index], 'SsoUsers', value,
+                          [shard_reference(shards, locations[value]),
+                           indexes['SsoNames'][value]])
+
+    return shards
+
+
+def shard_duplicates(shard):
+    '''
+    Return the AccountNames a shard skips and the names, emails and SSO
+    users indexes (see find_conflicts) its rows start from, decoded from
+    the Duplicates set by prescan_shards
+    '''
+
+    duplicates = shard.get('Duplicates', {})
+
+    return (set(duplicates.get('Skip', [])),
+            {int(value): first for (value, first)
+             in duplicates.get('Names', {}).items()},
+            {int(value): first for (value, first)
+             in duplicates.get('Emails', {}).items()},
+            {int(value): tuple(first) for (value, first)
+             in duplicates.get('SsoUsers', {}).items()})
+
+
+def invoke_shard(function_name, shard):
+    '''
+    Run a shard in a synchronous invocation of function_name. A failed
+    or timed out invocation is reported as an Error and never retried,
+    so its rows are not ingested twice.
+    '''
+
+    result = {'Rows': 0, 'Failed': [], 'Error': 'Invocation failed'}
+
+    try:
+        response = LAMBDA.invoke(FunctionName=function_name,
+                                 InvocationType='RequestResponse',
+                                 Payload=json.dumps({'Shard': shard}))
+        payload = json.loads(response['Payload'].read())
+        if 'FunctionError' in response:
+            result['Error'] = payload.get('errorMessage', result['Error'])
+        else:
+            result = payload
+    except (ClientError, BotoCoreError) as exe:
+        LOGGER.error('Unable to invoke %s for %s:%s: %s', function_name,
+                     shard['Key'], shard['Start'], str(exe))
+        result['Error'] = str(exe)
+
+    return result
+
+
+def fan_out(function_name, bucket, prefix, row_keys):
+    '''
+    Ingest every object under prefix with one invocation of
+    function_name per shard, SHARD_WORKERS at a time, and join the
+    results. row_keys is passed to prescan_shards. Return number of rows
+    processed and list of AccountNames (or shard Key:Start for shards
+    that failed) not written.
+    '''
+
+    rows = 0
+    failed = list()
+    shards = prescan_shards(list_shards(bucket, prefix), row_keys)
+    LOGGER.info('Ingesting %s shards under %s/%s', len(shards), bucket, prefix)
+
+    with ThreadPoolExecutor(max_workers=max(1, SHARD_WORKERS)) as pool:
+        results = pool.map(lambda shard: invoke_shard(function_name, shard),
+                           shards)
+        for (shard, result) in zip(shards, results):
+            rows += result['Rows']
+            failed += result['Failed']
+            if result.get('Error'):
+                LOGGER.error('Shard %s:%s failed: %s', shard['Key'],
+                             shard['Start'], result['Error'])
+                failed.append('%s:%s' % (shard['Key'], shard['Start']))
+
+    LOGGER.info('Ingested %s rows from %s shards, %s not written',
+                rows, len(shards), len(failed))
+
+    return (rows, failed)
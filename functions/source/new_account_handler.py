@@ -22,53 +22,63 @@
 This lamdba validates the input file and updates the dynamodb as needed
 '''
 
+# Taken before the other imports so MEASURE_IMPORT covers them
+# pylint: disable=wrong-import-position
+from time import perf_counter
+IMPORT_STARTED = perf_counter()
+
 import os
 import re
+import json
+import math
 import logging
+import argparse
 import csv
+import hashlib
+from collections import Counter
+from datetime import datetime, timezone
+from time import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlopen
-import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+import apimetrics
+import awsclients
 import cfnresource
+import dynotable
+import fanout
+import orgcache
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
-DYNO = boto3.client('dynamodb')
-ORG = boto3.client('organizations')
-SSS = boto3.client('s3')
+DYNO = awsclients.lazy_client('dynamodb')
+ORG = awsclients.lazy_client('organizations')
+SSS = awsclients.lazy_client('s3')
+SSO_ADMIN = awsclients.lazy_client('sso-admin')
+IDSTORE = awsclients.lazy_client('identitystore')
 TABLE_NAME = os.environ.get("TABLE_NAME")
+STATE_TABLE_NAME = os.environ.get("STATE_TABLE_NAME")
 BUCKET_NAME = os.environ.get("BATCH_BUCKET_NAME")
 KEY_NAME = os.environ.get("BATCH_KEY_NAME")
-
-
-def dyno_scan(table_name):
-    '''Return list of OUs in the organization'''
-
-    result = list()
-
-    try:
-        dyno_paginator = DYNO.get_paginator('scan')
-        dyno_page_iterator = dyno_paginator.paginate(TableName=table_name)
-    except ClientError as exe:
-        LOGGER.error('Unable to scan the table: %s', str(exe))
-
-    for page in dyno_page_iterator:
-        result += page['Items']
-
-    return result
-
-
-def get_items(status):
-    '''Get list of Valid entries to be provisioned'''
-
-    result = list()
-    items = dyno_scan(TABLE_NAME)
-
-    for item in items:
-        if item['Status']['S'] == status:
-            result.append(item)
-
-    return result
+KEY_PREFIX = os.environ.get("BATCH_KEY_PREFIX")
+OU_CRAWL_WORKERS = int(os.environ.get("OU_CRAWL_WORKERS", "8"))
+BATCH_WRITE_WORKERS = int(os.environ.get("BATCH_WRITE_WORKERS", "4"))
+WRITE_CHUNK_ROWS = int(os.environ.get("WRITE_CHUNK_ROWS", "500"))
+MAX_IN_FLIGHT = max(1, int(os.environ.get("MAX_IN_FLIGHT", "1")))
+# Seconds per account assumed by plans until provisioning has been measured
+PROVISION_SECONDS = int(os.environ.get("PROVISION_SECONDS", "1800"))
+EMAIL_PATTERN = re.compile(r'[^\s@]+@[^\s@]+\.[^\s@]+')
+REQUIRED_FIELDS = ('AccountName', 'AccountEmail', 'SSOUserEmail',
+                   'OrgUnit', 'SSOUserFirstName', 'SSOUserLastName')
+# Rows in these states are never re-validated or overwritten
+LOCKED_STATUSES = ('IN_PROGRESS', 'SUCCEEDED')
+VALIDATE_SSO_USERS = os.environ.get("VALIDATE_SSO_USERS", "false") == "true"
+SSO_LOOKUP_WORKERS = int(os.environ.get("SSO_LOOKUP_WORKERS", "8"))
+SSO_CACHE_TTL = int(os.environ.get("SSO_CACHE_TTL", "300"))
+
+# Identity Center lookups kept across warm invocations; SSO_USERS holds
+# email:(user, expiry) so users created meanwhile are found
+IDENTITY_STORE = {}
+SSO_USERS = {}
 
 
 def list_org_roots():
@@ -125,81 +135,101 @@ def list_ou_names():
     return get_ou_map().values()
 
 
-def list_children(parent_id, c_type='ORGANIZATIONAL_UNIT'):
+def list_ous_for_parent(parent_id, failed=None):
     '''
-    List all children for a OU
+    List all child OUs (with names) for a root or OU. If the listing
+    fails, parent_id is appended to failed.
     '''
 
     result = list()
 
     try:
-        paginator = ORG.get_paginator('list_children')
-        iterator = paginator.paginate(ParentId=parent_id,
-                                     ChildType=c_type)
+        paginator = ORG.get_paginator('list_organizational_units_for_parent')
+        for page in paginator.paginate(ParentId=parent_id):
+            result += page['OrganizationalUnits']
     except ClientError as exe:
-        LOGGER.error('Unable to get children: %s', str(exe))
-
-    for page in iterator:
-        result += page['Children']
+        LOGGER.error('Unable to get children of %s: %s', parent_id, str(exe))
+        if failed is not None:
+            failed.append(parent_id)
 
     return result
 
 
-def get_child_ous(prev_level):
+def crawl_ou_tree(root_id, max_workers=OU_CRAWL_WORKERS, failed=None):
     '''
-    Return all child OUs
+    Return ou-id:{Name, ParentId, Path} for every OU under root_id.
+    Sibling subtrees are listed concurrently on a bounded thread pool,
+    one level of the tree per round, so any depth is supported. Parents
+    whose children could not be listed are appended to failed.
     '''
 
-    result = list()
+    ou_tree = dict()
+    paths = {root_id: ''}
+    level = [root_id]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while level:
+            next_level = list()
+            for (parent_id, children) in zip(
+                    level, pool.map(
+                        lambda parent_id: list_ous_for_parent(parent_id,
+                                                              failed),
+                        level)):
+                for child in children:
+                    path = paths[parent_id] + '/' + child['Name']
+                    paths[child['Id']] = path
+                    ou_tree[child['Id']] = {'Name': child['Name'],
+                                            'ParentId': parent_id,
+                                            'Path': path}
+                    next_level.append(child['Id'])
+            level = next_level
+
+    return ou_tree
+
+
+def get_ou_tree():
+    '''
+    Return ou-id:{Name, ParentId, Path} mapping for the organization
+    '''
 
-    for item in prev_level:
-        child = list_children(item['Id'])
-        if len(child) > 0:
-            result += list_children(item['Id'])
+    ou_tree = dict()
+    root_id = list_org_roots()
 
-    return result
+    if root_id:
+        ou_tree = crawl_ou_tree(root_id)
+
+    return ou_tree
 
-def get_ou_map():
+
+def get_ou_map(ou_tree=None):
     '''
     Return ou-id:ou-name mapping dict
     '''
 
-    ou_map = dict()
-    root_id=list_org_roots()
-    lvl_one = list_children(root_id)
-    lvl_two = get_child_ous(lvl_one)
-    lvl_three = get_child_ous(lvl_two)
-    lvl_four = get_child_ous(lvl_three)
-    lvl_five = get_child_ous(lvl_four)
-    result = lvl_one + lvl_two + lvl_three + lvl_four + lvl_five
+    if ou_tree is None:
+        ou_tree = get_ou_tree()
 
-    for item in result:
-        ou_id=item['Id']
-        ou_info=ORG.describe_organizational_unit(OrganizationalUnitId=ou_id)
-        ou_name=ou_info['OrganizationalUnit']['Name']
-        ou_map[ou_id] = ou_name
+    return {ou_id: info['Name'] for (ou_id, info) in ou_tree.items()}
 
-    return ou_map
 
-
-def list_of_accounts():
+def list_of_accounts(failed=None):
     '''
-    Return list of accounts in the organization
+    Return list of accounts in the organization. If the listing fails,
+    'ListAccounts' is appended to failed.
     '''
 
     result = list()
     account_list = list()
 
-    root_id = list_org_roots()
-
     try:
-        org_paginator = ORG.get_paginator('list_accounts_for_parent')
-        org_page_iterator = org_paginator.paginate(ParentId=root_id)
+        org_paginator = ORG.get_paginator('list_accounts')
+        org_page_iterator = org_paginator.paginate()
+        for page in org_page_iterator:
+            result += page['Accounts']
     except ClientError as exe:
         LOGGER.error('Unable to get Accounts list: %s', str(exe))
-
-    for page in org_page_iterator:
-        result += page['Accounts']
+        if failed is not None:
+            failed.append('ListAccounts')
 
     for item in result:
         account_list.append(item['Email'])
@@ -207,13 +237,48 @@ def list_of_accounts():
     return account_list
 
 
+def normalize_email(email):
+    '''
+    Return email in the form used for case-insensitive comparison
+    '''
+
+    return email.strip().lower()
+
+
+def get_email_index(failed=None):
+    '''
+    Return set of normalized emails for all accounts in the organization
+    '''
+
+    return {normalize_email(email) for email in list_of_accounts(failed)}
+
+
+def build_org_snapshot():
+    '''
+    Return roots, OU tree and account emails crawled from Organizations,
+    with Complete False if any of the calls failed
+    '''
+
+    failed = list()
+    root_id = list_org_roots()
+    roots = [root_id] if root_id else list()
+    ou_tree = crawl_ou_tree(root_id, failed=failed) if root_id else dict()
+    emails = get_email_index(failed)
+
+    if not root_id:
+        failed.append('ListRoots')
+
+    return {'Roots': roots, 'OUs': ou_tree, 'Emails': emails,
+            'Complete': not failed}
+
+
 def validate_org_unit(org_unit, ou_list=None):
     '''
     Return True if Org exists
     '''
 
     orgexist = False
-    if not ou_list:
+    if ou_list is None:
         ou_list = list_ou_names()
 
     ou_name = org_unit.split('(ou-')[0].rstrip()
@@ -224,33 +289,123 @@ def validate_org_unit(org_unit, ou_list=None):
     return orgexist
 
 
-def is_email_exists(email):
+def is_email_exists(email, email_index=None):
     '''
     Return True if email exists in current organization
     '''
 
-    emailexist = False
-    email_list = list_of_accounts()
+    if email_index is None:
+        email_index = get_email_index()
+
+    return normalize_email(email) in email_index
+
+
+def get_identity_store_id():
+    '''
+    Return the identity store of the Identity Center instance, None if
+    there is none or it cannot be read
+    '''
+
+    if 'Id' not in IDENTITY_STORE:
+        try:
+            instances = SSO_ADMIN.list_instances()['Instances']
+            IDENTITY_STORE['Id'] = instances[0]['IdentityStoreId'] \
+                if instances else None
+        except (ClientError, BotoCoreError) as exe:
+            LOGGER.error('Unable to find Identity Center instance: %s',
+                         str(exe))
+            return None
+
+    return IDENTITY_STORE['Id']
+
+
+def lookup_sso_user(store_id, email):
+    '''
+    Return (GivenName, FamilyName) of the Identity Center user whose
+    UserName is email, None if there is no such user and False if the
+    lookup failed
+    '''
+
+    result = False
+
+    try:
+        users = IDSTORE.list_users(
+            IdentityStoreId=store_id,
+            Filters=[{'AttributePath': 'UserName',
+                      'AttributeValue': email}])['Users']
+        result = None
+        if users:
+            name = users[0].get('Name', {})
+            result = (name.get('GivenName', ''), name.get('FamilyName', ''))
+    except (ClientError, BotoCoreError) as exe:
+        LOGGER.error('Unable to look up SSO user %s: %s', email, str(exe))
+
+    return result
+
+
+def resolve_sso_users(emails, max_workers=SSO_LOOKUP_WORKERS):
+    '''
+    Return normalized email:(GivenName, FamilyName) or None for the
+    distinct emails given. Emails not seen within SSO_CACHE_TTL seconds
+    are looked up concurrently on a bounded thread pool and cached;
+    failed lookups are left out so those rows are not judged.
+    '''
+
+    store_id = get_identity_store_id()
+    wanted = {normalize_email(email) for email in emails}
+    now = time()
 
-    if email in email_list:
-        emailexist = True
-    return emailexist
+    if not store_id:
+        return dict()
 
+    pending = sorted(email for email in wanted
+                     if SSO_USERS.get(email, (None, 0))[1] <= now)
 
-def validateinput(row, ou_info=None):
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            for (email, user) in zip(pending, pool.map(
+                    lambda email: lookup_sso_user(store_id, email), pending)):
+                if user is False:
+                    SSO_USERS.pop(email, None)
+                else:
+                    SSO_USERS[email] = (user, now + SSO_CACHE_TTL)
+        LOGGER.info('Looked up %s SSO users, %s cached',
+                    len(pending), len(wanted) - len(pending))
+
+    return {email: SSO_USERS[email][0] for email in wanted
+            if email in SSO_USERS}
+
+
+def sso_user_conflict(row, sso_users):
     '''
-    Return validation status and error list if found any
+    Return an error if the row's SSOUserEmail belongs to an Identity
+    Center user with another first or last name, None otherwise
+    '''
+
+    result = None
+    user = sso_users.get(normalize_email(row['SSOUserEmail']))
+    wanted = (row['SSOUserFirstName'], row['SSOUserLastName'])
+
+    if user and [part.strip().lower() for part in user] != \
+            [part.strip().lower() for part in wanted]:
+        result = ("SSOUserEmail " + row['SSOUserEmail'] +
+                  " belongs to Identity Center user " + ' '.join(user) +
+                  ", not " + ' '.join(wanted))
+
+    return result
+
+
+def check_local_rules(row):
+    '''
+    Return errors found in the row without looking at the organization
     '''
 
     error_list = list()
-    validation = 'VALID'
-    emailexpression = r'[^\s@]+@[^\s@]+\.[^\s@]+'
-    fields = ['AccountName', 'AccountEmail', 'SSOUserEmail',
-              'OrgUnit', 'SSOUserFirstName', 'SSOUserLastName']
 
-    for field in fields:
-        if row[field] == 'None':
+    for field in REQUIRED_FIELDS:
+        if row.get(field) in (None, '', 'None'):
             error_list.append(field + "is a required field.")
+            row[field] = row.get(field) or ''
 
     if len(row['AccountName']) > 50:
         error_list.append("AccountName should be less than 50 characters., ")
@@ -258,15 +413,102 @@ def validateinput(row, ou_info=None):
         error_list.append("AccountEmail should be more than 6 characters., ")
     if len(row['SSOUserEmail']) < 7:
         error_list.append("SSOUserEmail should be more than 6 characters., ")
-    if re.match(emailexpression, row['AccountEmail']) is None:
+    if EMAIL_PATTERN.match(row['AccountEmail']) is None:
         error_list.append("AccountEmail is not valid., ")
-    if re.match(emailexpression, row['SSOUserEmail']) is None:
+    if EMAIL_PATTERN.match(row['SSOUserEmail']) is None:
         error_list.append("SSOUserEmail is not valid., ")
-    if not validate_org_unit(row['OrgUnit'], ou_info):
-        error_list.append("OrgUnit " + row['OrgUnit'] + " is not valid")
-    if is_email_exists(row['AccountEmail']):
-        error_list.append("Account email - " + row['AccountEmail']
-                          + " in use by another account")
+
+    return error_list
+
+
+def is_keyless(row, line):
+    '''
+    Return True if the row has no AccountName and so cannot be stored.
+    Empty lines such as a trailing ",,,,," are dropped without a warning.
+    '''
+
+    result = not row['AccountName']
+
+    if result and any(row[field] for field in REQUIRED_FIELDS):
+        LOGGER.warning('Skipping row %s without an AccountName', line)
+
+    return result
+
+
+def digest(value):
+    '''
+    Return a 64-bit digest of value. The duplicate indexes are keyed by
+    it so their size does not grow with the length of names and emails.
+    '''
+
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'),
+                                          digest_size=8).digest(), 'big')
+
+
+def sso_name(row):
+    '''Return the digest of the row's SSO user first and last name'''
+
+    return digest('\x1f'.join(row.get(field, '').strip().lower() for field
+                              in ('SSOUserFirstName', 'SSOUserLastName')))
+
+
+def find_conflicts(row, line, names, emails, sso_users):
+    '''
+    Return errors for an AccountName or AccountEmail already used by an
+    earlier row of the file, or an SSOUserEmail an earlier row gave
+    another first or last name. The row is added to the names/emails
+    indexes, which map the digest of a value to the line it was first
+    used on, and to sso_users, which maps it to (line, sso_name).
+    '''
+
+    error_list = list()
+    name = digest(row['AccountName'])
+    email = digest(normalize_email(row['AccountEmail']))
+
+    if name in names:
+        error_list.append("AccountName " + row['AccountName']
+                          + " duplicates row " + str(names[name]) + ", ")
+    else:
+        names[name] = line
+
+    if email in emails:
+        error_list.append("AccountEmail " + row['AccountEmail']
+                          + " also used by row " + str(emails[email]) + ", ")
+    else:
+        emails[email] = line
+
+    if row['SSOUserEmail']:
+        (first, named) = sso_users.setdefault(
+            digest(normalize_email(row['SSOUserEmail'])),
+            (line, sso_name(row)))
+        if named != sso_name(row):
+            error_list.append("SSOUserEmail " + row['SSOUserEmail']
+                              + " has another first or last name on row "
+                              + str(first) + ", ")
+
+    return error_list
+
+
+def validateinput(row, ou_info=None, email_index=None, sso_users=None):
+    '''
+    Return validation status and error list if found any. Organization
+    and Identity Center checks only run for rows that pass the local
+    rules; sso_users is the result of resolve_sso_users, None to skip.
+    '''
+
+    validation = 'VALID'
+    error_list = check_local_rules(row)
+
+    if len(error_list) == 0:
+        if not validate_org_unit(row['OrgUnit'], ou_info):
+            error_list.append("OrgUnit " + row['OrgUnit'] + " is not valid")
+        if is_email_exists(row['AccountEmail'], email_index):
+            error_list.append("Account email - " + row['AccountEmail']
+                              + " in use by another account")
+        if sso_users is not None:
+            conflict = sso_user_conflict(row, sso_users)
+            if conflict:
+                error_list.append(conflict)
 
     if len(error_list) > 0:
         validation = 'INVALID'
@@ -278,7 +520,8 @@ def validateinput(row, ou_info=None):
 
 def read_file(name, key_name='sample.csv', method='s3'):
     '''
-    Return file content if exist
+    Return an iterator over the file lines if exist. The file is
+    streamed, so lines are available before the download completes.
     '''
 
     LOGGER.info('BUCKET NAME: %s, KEY NAME: %s', name, key_name)
@@ -288,10 +531,12 @@ def read_file(name, key_name='sample.csv', method='s3'):
             LOGGER.info('METHOD: %s', method)
             body = SSS.get_object(Bucket=name,
                                   Key=key_name)['Body']
-            result = body.read().decode('utf-8-sig')
+            result = fanout.iter_lines(body.iter_chunks(
+                chunk_size=fanout.READ_CHUNK_SIZE))
         elif method == 'https':
             file = urlopen(name)
-            result = file.read().decode('utf-8-sig')
+            result = fanout.iter_lines(iter(
+                lambda: file.read(fanout.READ_CHUNK_SIZE), b''))
         else:
             raise Exception('UNSUPPORTED_METHOD')
     except ClientError as exe:
@@ -300,61 +545,392 @@ def read_file(name, key_name='sample.csv', method='s3'):
     return result
 
 
-def validate_update_dyno(content, table_name):
+def ingest_shard(shard):
+    '''Validate and write one shard. Return Rows and Failed names'''
+
+    result = {'Rows': 0, 'Failed': []}
+    content = fanout.read_shard(shard)
+
+    if content is None:
+        result['Error'] = 'Unable to read the shard'
+    else:
+        (result['Rows'], result['Failed']) = validate_update_dyno(
+            content, TABLE_NAME, shard)
+
+    LOGGER.info('Shard %s/%s [%s, %s): %s rows, %s failed', shard['Bucket'],
+                shard['Key'], shard['Start'], shard['End'], result['Rows'],
+                len(result['Failed']))
+
+    return result
+
+
+def row_keys(row):
+    '''
+    Return the AccountName, AccountEmail and SSOUserEmail (None if empty)
+    digests fanout.prescan_shards checks for repeats, with the sso_name,
+    as find_conflicts computes them. None for a row without AccountName.
+    '''
+
+    result = None
+    sso = normalize_email(row.get('SSOUserEmail') or '')
+
+    if row.get('AccountName'):
+        result = ({'AccountName': digest(row['AccountName']),
+                   'AccountEmail': digest(normalize_email(
+                       row.get('AccountEmail') or '')),
+                   'SSOUserEmail': digest(sso) if sso else None},
+                  sso_name(row))
+
+    return result
+
+
+def row_hash(row):
+    '''Return the content hash of the input fields of a row'''
+
+    content = '\x1f'.join(row.get(field) or '' for field in REQUIRED_FIELDS)
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def build_item(row, validation, errormsg, generation=0):
     '''
-    Validate and update dyno table
+    Return the DynamoDB item for a validated row. generation counts the
+    times ingestion has rewritten the row. VALID items are put on the
+    queue index.
     '''
 
-    response = False
-    ou_info = list_ou_names()
+    item = {
+        'RowHash': {'S': row_hash(row)},
+        'Generation': {'N': str(generation)},
+        'AccountName': {'S': row['AccountName'], },
+        'SSOUserEmail': {'S': row['SSOUserEmail'], },
+        'AccountEmail': {'S': row['AccountEmail'], },
+        'SSOUserFirstName': {'S': row['SSOUserFirstName'], },
+        'SSOUserLastName': {'S': row['SSOUserLastName'], },
+        'OrgUnit': {'S': row['OrgUnit'], },
+        'Status': {'S': validation},
+        'AccountId': {'S': 'UNKNOWN'},
+        'Message': {'S': str(errormsg)}
+    }
+
+    if validation in dynotable.QUEUE_STATUSES:
+        item['QueueStatus'] = {'S': validation}
+
+    return item
 
-    for row in csv.DictReader(content.splitlines()):
-        (validation, errormsg) = validateinput(row, ou_info)
+
+def write_items(table_name, items, failed):
+    '''
+    Write a chunk of items, appending names of unwritten rows to failed.
+    Return number of items written.
+    '''
+
+    results = dynotable.batch_write_items(table_name, items,
+                                          max_workers=BATCH_WRITE_WORKERS)
+    unwritten = [name for (name, written) in results.items() if not written]
+    failed += unwritten
+
+    return len(results) - len(unwritten)
+
+
+def upsert_rows(table_name, rows, org, run):
+    '''
+    Validate and write the new or changed rows of a chunk. rows is a list
+    of (row, conflicts); org is (ou_info, email_index). Rows whose stored
+    item is in LOCKED_STATUSES, or is VALID with the same RowHash and no
+    new conflicts, are skipped. INVALID, NOT_PROVISIONED and FAILED rows
+    are validated again; the rewritten item has no Attempts or
+    NextAttemptAt and the next Generation, so its launches get new
+    provision tokens. With VALIDATE_SSO_USERS the SSO users of the
+    remaining rows are resolved against Identity Center first. The batch
+    summary counters are moved by the rows written. run collects the
+    number of rows written and skipped, the counter change and the rows
+    that failed.
+    '''
+
+    items = list()
+    changed = list()
+    statuses = dict()
+    unwritten = list()
+    deltas = Counter()
+    sso_users = None
+    (stored, unread) = dynotable.batch_get_items(
+        table_name, [row['AccountName'] for (row, _) in rows],
+        attributes=('RowHash', 'Status', 'Generation'))
+    run['failed'] += unread
+    unread = set(unread)
+
+    for (row, conflicts) in rows:
+        name = row['AccountName']
+        old = stored.get(name, {})
+        old_status = old.get('Status', {}).get('S')
+        if name in unread:
+            continue
+        if old_status in LOCKED_STATUSES or (
+                old_status == 'VALID' and not conflicts and
+                old.get('RowHash', {}).get('S') == row_hash(row)):
+            run['skipped'] += 1
+            continue
+        generation = int(old['Generation']['N']) + 1 \
+            if 'Generation' in old else int(bool(old))
+        changed.append((row, conflicts, old_status, generation))
+
+    if VALIDATE_SSO_USERS and changed:
+        sso_users = resolve_sso_users(
+            [row['SSOUserEmail'] for (row, conflicts, _, _) in changed
+             if not conflicts and not check_local_rules(row)])
+
+    for (row, conflicts, old_status, generation) in changed:
+        name = row['AccountName']
+        (validation, errormsg) = validateinput(row, *org, sso_users)
+        if conflicts:
+            validation = 'INVALID'
+            errormsg = conflicts + errormsg
+        # A repeated name is written once, with its last row
+        statuses[name] = (validation, old_status)
         LOGGER.info('Inserting Row: %s in %s, %s',
-                    row['AccountName'], row['OrgUnit'], str(errormsg))
-        try:
-            response = DYNO.put_item(
-                Item={
-                    'AccountName': {'S': row['AccountName'], },
-                    'SSOUserEmail': {'S': row['SSOUserEmail'], },
-                    'AccountEmail': {'S': row['AccountEmail'], },
-                    'SSOUserFirstName': {'S': row['SSOUserFirstName'], },
-                    'SSOUserLastName': {'S': row['SSOUserLastName'], },
-                    'OrgUnit': {'S': row['OrgUnit'], },
-                    'Status': {'S': validation},
-                    'AccountId': {'S': 'UNKNOWN'},
-                    'Message': {'S': str(errormsg)}
-                },
-                TableName=table_name,
-                )
-        except ClientError as exe:
-            LOGGER.error('Unable to update the table: %s', str(exe))
-
-    return response
+                    name, row['OrgUnit'], str(errormsg))
+        items.append(build_item(row, validation, errormsg, generation))
 
+    if items:
+        write_items(table_name, items, unwritten)
+        run['failed'] += unwritten
 
-def account_handler(event, context):
+    for name in set(statuses) - set(unwritten):
+        (validation, old_status) = statuses[name]
+        deltas[validation] += 1
+        if old_status:
+            deltas[old_status] -= 1
+
+    run['written'] += len(set(statuses) - set(unwritten))
+    run['deltas'].update(deltas)
+
+    if not dynotable.add_status_counts(STATE_TABLE_NAME, deltas):
+        LOGGER.error('Batch summary misses the change: %s', dict(deltas))
+
+
+def validate_update_dyno(content, table_name, shard=None):
     '''
-    Lambda Handler
+    Validate and update dyno table. content is an iterable of CSV lines;
+    rows are diffed against the table in chunks as they are read, and only
+    new or changed rows are validated and written. Rows repeating an
+    earlier AccountName or AccountEmail, or naming an earlier row's
+    SSOUserEmail differently, are INVALID; a repeated AccountName
+    replaces the earlier row's item, so that one ends up INVALID too.
+    Rows without an AccountName are skipped. The batch summary counters
+    are adjusted chunk by chunk. For a fan-out shard, the LinesBefore and
+    Duplicates set by fanout.prescan_shards are applied. Return number of rows
+    read and list of AccountNames that could not be written.
     '''
 
-    result = False
+    chunk = list()
+    rows = 0
+    shard = shard or {}
+    (skip, names, emails, sso_users) = fanout.shard_duplicates(shard)
+    run = {'written': 0, 'skipped': 0, 'deltas': Counter(), 'failed': list()}
+    snapshot = orgcache.get_snapshot(build_org_snapshot)
+    org = (set(get_ou_map(snapshot['OUs']).values()), snapshot['Emails'])
+    LOGGER.info('Loaded %s OUs and %s account emails from org snapshot v%s',
+                len(org[0]), len(org[1]), snapshot['Version'])
 
-    if event['RequestType'] == 'Create':
-        fcontent = read_file(BUCKET_NAME, KEY_NAME)
+    if isinstance(content, str):
+        content = content.splitlines()
+
+    reader = csv.DictReader(content)
+
+    for row in reader:
+        line = reader.line_num + shard.get('LinesBefore', 0)
+        for field in REQUIRED_FIELDS:
+            row[field] = row.get(field) or ''
+        if is_keyless(row, line):
+            continue
+        conflicts = find_conflicts(row, line, names, emails, sso_users)
+        rows += 1
+        # Written by the shard holding the last row of the name
+        if digest(row['AccountName']) in skip:
+            continue
+        chunk.append((row, conflicts))
+
+        if len(chunk) >= WRITE_CHUNK_ROWS:
+            upsert_rows(table_name, chunk, org, run)
+            chunk = list()
+
+    if chunk:
+        upsert_rows(table_name, chunk, org, run)
+
+    LOGGER.info('Wrote %s rows, skipped %s unchanged, summary change: %s',
+                run['written'], run['skipped'], dict(run['deltas']))
+
+    return (rows, run['failed'])
+
+
+def plan_rows(content, snapshot):
+    '''
+    Validate content against an org snapshot without writing anything.
+    Return AccountName:(Status, OrgUnit, errors) for the rows; a repeated
+    AccountName keeps the last row, as the table would.
+    '''
+
+    planned = dict()
+    names = dict()
+    emails = dict()
+    sso_users = dict()
+    ou_info = set(get_ou_map(snapshot['OUs']).values())
+
+    if isinstance(content, str):
+        content = content.splitlines()
+
+    reader = csv.DictReader(content)
+
+    for row in reader:
+        for field in REQUIRED_FIELDS:
+            row[field] = row.get(field) or ''
+        if is_keyless(row, reader.line_num):
+            continue
+        conflicts = find_conflicts(row, reader.line_num, names, emails,
+                                   sso_users)
+        (validation, errormsg) = validateinput(row, ou_info,
+                                               snapshot['Emails'])
+        if conflicts:
+            validation = 'INVALID'
+            errormsg = conflicts + errormsg
+        planned[row['AccountName']] = (validation, row['OrgUnit'], errormsg)
 
+    return planned
+
+
+def build_plan(content, snapshot, concurrency, seconds_per_account):
+    '''
+    Return the planned VALID/INVALID split, per-OU counts and estimated
+    provisioning time of content, concurrency accounts at a time
+    '''
+
+    planned = plan_rows(content, snapshot)
+    counts = Counter(status for (status, _, _) in planned.values())
+    org_units = dict()
+
+    for (status, org_unit, _) in planned.values():
+        org_units.setdefault(org_unit, Counter())[status] += 1
+
+    seconds = math.ceil(counts['VALID'] / concurrency) * seconds_per_account
+
+    return {
+        'SnapshotVersion': snapshot.get('Version'),
+        'Counts': dict(counts),
+        'OrgUnits': {ou: dict(ou_counts) for (ou, ou_counts)
+                     in sorted(org_units.items())},
+        'Invalid': {name: errors for (name, (status, _, errors))
+                    in planned.items() if status == 'INVALID'},
+        'Concurrency': concurrency,
+        'SecondsPerAccount': round(seconds_per_account),
+        'EstimatedSeconds': round(seconds),
+        'EstimatedCompletion': datetime.fromtimestamp(
+            time() + seconds, timezone.utc).isoformat(timespec='seconds')
+        }
+
+
+def get_seconds_per_account():
+    '''
+    Return measured mean provisioning seconds per account, or
+    PROVISION_SECONDS if nothing has been measured yet
+    '''
+
+    result = None
+
+    if STATE_TABLE_NAME:
+        result = dynotable.get_provision_time(STATE_TABLE_NAME)
+
+    return result or PROVISION_SECONDS
+
+
+def plan_batch(event):
+    '''
+    Return the plan for the input file (or event Bucket/Key) using the
+    cached org snapshot. Nothing is written and Organizations is not
+    called.
+    '''
+
+    result = {'error': 'No cached org snapshot to plan against'}
+    snapshot = orgcache.get_cached_snapshot()
+
+    if snapshot:
+        content = read_file(event.get('Bucket', BUCKET_NAME),
+                            event.get('Key', KEY_NAME))
+        if content:
+            result = build_plan(
+                content, snapshot,
+                max(1, int(event.get('Concurrency', MAX_IN_FLIGHT))),
+                get_seconds_per_account())
+        else:
+            result = {'error': 'Unable to read the input file'}
+
+    LOGGER.info('Plan: %s', json.dumps(result))
+
+    return result
+
+
+def ingest(function_name):
+    '''
+    Ingest the input file, or every object under KEY_PREFIX if set.
+    Return number of rows processed and list of rows not written, None if
+    the input file could not be read.
+    '''
+
+    result = None
+
+    if KEY_PREFIX:
+        # Refreshed once here so the shards share it instead of each crawling
+        orgcache.get_snapshot(build_org_snapshot)
+        result = fanout.fan_out(function_name, BUCKET_NAME, KEY_PREFIX,
+                                row_keys)
+    else:
+        fcontent = read_file(BUCKET_NAME, KEY_NAME)
         if fcontent:
             LOGGER.info('Updating DynamoDB: %s', TABLE_NAME)
-            update_response = validate_update_dyno(fcontent, TABLE_NAME)
+            result = validate_update_dyno(fcontent, TABLE_NAME)
+
+    return result
+
 
-            if update_response:
+def account_handler(event, context):
+    '''
+    Lambda Handler. An event with PlanOnly set returns the plan for the
+    input file instead, and one with a Shard ingests that shard for a
+    fan-out coordinator. Other events return True if the input loaded.
+    '''
+
+    result = False
+    function_name = getattr(context, 'function_name', 'new_account_handler')
+    awsclients.set_deadline(context)
+
+    if event.get('PlanOnly') or event.get('Shard'):
+        if event.get('PlanOnly'):
+            result = plan_batch(event)
+        else:
+            result = ingest_shard(event['Shard'])
+        apimetrics.flush(function_name)
+        return result
+
+    if event['RequestType'] in ('Create', 'Update'):
+        ingested = ingest(function_name)
+
+        if ingested:
+            (rows, failed) = ingested
+
+            if rows and not failed:
                 result = True
+            elif failed:
+                LOGGER.error('Unable to write %s rows: %s',
+                             len(failed), failed)
 
-            if len(get_items('INVALID')) > 0:
-                LOGGER.warning('INVALID Entries: %s', get_items('INVALID'))
+            counts = dynotable.get_status_counts(STATE_TABLE_NAME) or {}
+            if counts.get('INVALID', 0) > 0:
+                LOGGER.warning('INVALID Entries: %s', counts['INVALID'])
     else:
         result = True
 
+    apimetrics.flush(function_name)
+
     if result is True:
         response = {}
         cfnresource.send(event, context, cfnresource.SUCCESS,
@@ -364,3 +940,54 @@ def account_handler(event, context):
         LOGGER.error(response)
         cfnresource.send(event, context, cfnresource.FAILED,
                          response, "CustomResourcePhysicalID")
+
+    return result
+
+
+awsclients.log_timing('import new_account_handler', IMPORT_STARTED)
+
+
+def main():
+    '''Print the plan for a local input file'''
+
+    parser = argparse.ArgumentParser(
+        description='Validate a batch input file and estimate provisioning '
+                    'time without writing anything')
+    parser.add_argument('csv_file', help='batch input file')
+    parser.add_argument('--snapshot',
+                        help='org snapshot JSON file, default: the stored '
+                             'snapshot in STATE_TABLE_NAME')
+    parser.add_argument('--save-snapshot', metavar='FILE',
+                        help='write the snapshot used to a JSON file')
+    parser.add_argument('--concurrency', type=int, default=MAX_IN_FLIGHT,
+                        help='accounts provisioned at a time')
+    parser.add_argument('--seconds-per-account', type=float,
+                        help='default: measured mean from STATE_TABLE_NAME, '
+                             'else PROVISION_SECONDS')
+    args = parser.parse_args()
+
+    if args.snapshot:
+        with open(args.snapshot, encoding='utf-8') as file:
+            snapshot = json.load(file)
+        snapshot['Emails'] = set(snapshot['Emails'])
+    else:
+        snapshot = orgcache.get_cached_snapshot()
+    if not snapshot:
+        parser.error('no org snapshot, pass --snapshot or set '
+                     'STATE_TABLE_NAME')
+
+    if args.save_snapshot:
+        with open(args.save_snapshot, 'w', encoding='utf-8') as file:
+            json.dump(dict(snapshot, Emails=sorted(snapshot['Emails'])),
+                      file, indent=2)
+
+    with open(args.csv_file, newline='', encoding='utf-8-sig') as file:
+        plan = build_plan(file, snapshot, max(1, args.concurrency),
+                          args.seconds_per_account or
+                          get_seconds_per_account())
+
+    print(json.dumps(plan, indent=2))
+
+
+if __name__ == '__main__':
+    main()
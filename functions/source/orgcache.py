@@ -0,0 +1,264 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Versioned organization snapshot (roots, OU tree and account emails) kept in
+the batch state table and shared by both Lambdas
+'''
+
+import os
+import json
+import uuid
+import zlib
+import logging
+from time import time
+from botocore.exceptions import ClientError
+import awsclients
+import dynotable
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+DYNO = awsclients.lazy_client('dynamodb')
+STATE_TABLE_NAME = os.environ.get("STATE_TABLE_NAME")
+ORG_CACHE_TTL = int(os.environ.get("ORG_CACHE_TTL", "3600"))
+SNAPSHOT_KEY = 'ORG_SNAPSHOT'
+# Compressed snapshot bytes per part item, under the 400 KB item limit
+PART_BYTES = 300 * 1024
+
+# Copy of the snapshot kept across warm invocations
+CACHE = {}
+
+
+def part_key(data_id, index):
+    '''Return the StateKey of a part of the snapshot data data_id'''
+
+    return '%s#%s#%s' % (SNAPSHOT_KEY, data_id, index)
+
+
+def to_items(snapshot, data_id):
+    '''
+    Return the head item and the part items for a snapshot. Roots, OUs
+    and Emails are stored as compressed JSON split into parts of at most
+    PART_BYTES, so organizations of any size fit the item size limit.
+    '''
+
+    data = zlib.compress(json.dumps({
+        'Roots': snapshot['Roots'],
+        'OUs': snapshot['OUs'],
+        'Emails': sorted(snapshot['Emails'])
+        }, separators=(',', ':')).encode('utf-8'))
+    parts = [data[start:start + PART_BYTES]
+             for start in range(0, len(data), PART_BYTES)]
+
+    head = {
+        'StateKey': {'S': SNAPSHOT_KEY},
+        'Version': {'N': str(snapshot['Version'])},
+        'RefreshedAt': {'N': str(int(snapshot['RefreshedAt']))},
+        'DataId': {'S': data_id},
+        'Parts': {'N': str(len(parts))}
+        }
+
+    return (head, [{'StateKey': {'S': part_key(data_id, index)},
+                    'Data': {'B': part}}
+                   for (index, part) in enumerate(parts)])
+
+
+def from_items(head, parts):
+    '''
+    Return the snapshot stored in a head item and its part items, with
+    the emails added to the head since the crawl
+    '''
+
+    data = json.loads(zlib.decompress(
+        b''.join(part['Data']['B'] for part in parts)).decode('utf-8'))
+
+    return {
+        'Version': int(head['Version']['N']),
+        'RefreshedAt': int(head['RefreshedAt']['N']),
+        'Roots': data['Roots'],
+        'OUs': data['OUs'],
+        'Emails': set(data['Emails']) |
+                  set(head.get('Emails', {'SS': []})['SS'])
+        }
+
+
+def is_fresh(snapshot, ttl=ORG_CACHE_TTL):
+    '''Return True if the snapshot is younger than ttl seconds'''
+
+    return bool(snapshot) and time() - snapshot['RefreshedAt'] < ttl
+
+
+def get_stored_version():
+    '''Return version of the stored snapshot, None if there is none'''
+
+    result = None
+
+    try:
+        item = DYNO.get_item(TableName=STATE_TABLE_NAME,
+                             Key={'StateKey': {'S': SNAPSHOT_KEY}},
+                             ProjectionExpression='Version',
+                             ConsistentRead=True).get('Item')
+        if item:
+            result = int(item['Version']['N'])
+    except ClientError as exe:
+        LOGGER.error('Unable to read snapshot version: %s', str(exe))
+
+    return result
+
+
+def load_snapshot():
+    '''Return the stored snapshot, None if there is none'''
+
+    result = None
+
+    try:
+        head = DYNO.get_item(TableName=STATE_TABLE_NAME,
+                             Key={'StateKey': {'S': SNAPSHOT_KEY}},
+                             ConsistentRead=True).get('Item')
+        if head and 'DataId' in head:
+            keys = [part_key(head['DataId']['S'], index)
+                    for index in range(int(head['Parts']['N']))]
+            (parts, _) = dynotable.batch_get_items(
+                STATE_TABLE_NAME, keys, key_name='StateKey')
+            if len(parts) == len(keys):
+                result = from_items(head, [parts[key] for key in keys])
+            else:
+                LOGGER.error('Parts of org snapshot v%s are missing',
+                             head['Version']['N'])
+    except ClientError as exe:
+        LOGGER.error('Unable to read org snapshot: %s', str(exe))
+
+    return result
+
+
+def save_snapshot(snapshot):
+    '''
+    Store the snapshot: the parts under a new DataId first, then the head
+    item pointing at them, then remove the parts of the replaced snapshot.
+    Return True on success.
+    '''
+
+    result = False
+    old = None
+    (head, parts) = to_items(snapshot, uuid.uuid4().hex)
+
+    try:
+        for part in parts:
+            DYNO.put_item(TableName=STATE_TABLE_NAME, Item=part)
+        old = DYNO.put_item(TableName=STATE_TABLE_NAME, Item=head,
+                            ReturnValues='ALL_OLD').get('Attributes')
+        result = True
+    except ClientError as exe:
+        LOGGER.error('Unable to store org snapshot: %s', str(exe))
+
+    if old and 'DataId' in old:
+        for index in range(int(old['Parts']['N'])):
+            dynotable.delete_state(STATE_TABLE_NAME,
+                                   part_key(old['DataId']['S'], index))
+
+    return result
+
+
+def get_snapshot(loader, ttl=ORG_CACHE_TTL):
+    '''
+    Return a fresh org snapshot. The warm-start copy is used while it
+    matches the stored version, then the stored one, and loader() (a full
+    crawl of Organizations returning Roots, OUs and Emails, with Complete
+    False if any call failed) is only called when neither is younger than
+    ttl seconds. An incomplete crawl is neither stored nor cached; the
+    stale snapshot is used instead if there is one.
+    '''
+
+    if not STATE_TABLE_NAME:
+        snapshot = dict(loader(), Version=1, RefreshedAt=int(time()))
+        snapshot.pop('Complete', None)
+    elif is_fresh(CACHE, ttl) and get_stored_version() == CACHE['Version']:
+        LOGGER.info('Using cached org snapshot v%s', CACHE['Version'])
+        snapshot = CACHE
+    else:
+        stored = load_snapshot()
+        if is_fresh(stored, ttl):
+            LOGGER.info('Using stored org snapshot v%s', stored['Version'])
+            snapshot = stored
+        else:
+            version = stored['Version'] + 1 if stored else 1
+            snapshot = dict(loader(), Version=version, RefreshedAt=int(time()))
+            if snapshot.pop('Complete', True):
+                LOGGER.info('Refreshed org snapshot v%s: %s OUs, %s accounts',
+                            version, len(snapshot['OUs']),
+                            len(snapshot['Emails']))
+                save_snapshot(snapshot)
+            elif stored:
+                LOGGER.error('Organizations crawl failed, using stale org '
+                             'snapshot v%s', stored['Version'])
+                snapshot = stored
+            else:
+                LOGGER.error('Organizations crawl failed, using the partial '
+                             'crawl without caching it')
+                return snapshot
+        CACHE.clear()
+        CACHE.update(snapshot)
+
+    return snapshot
+
+
+def get_cached_snapshot():
+    '''
+    Return the warm-start or stored snapshot whatever its age, without
+    calling Organizations. None if there is neither.
+    '''
+
+    result = dict(CACHE) if CACHE else None
+
+    if result is None and STATE_TABLE_NAME:
+        result = load_snapshot()
+
+    return result
+
+
+def add_account_email(email):
+    '''
+    Add a newly created account email to the stored snapshot, bumping its
+    version. No-op if there is no snapshot yet.
+    '''
+
+    result = False
+    email = email.strip().lower()
+
+    try:
+        DYNO.update_item(TableName=STATE_TABLE_NAME,
+                         Key={'StateKey': {'S': SNAPSHOT_KEY}},
+                         UpdateExpression='ADD Emails :e, Version :one',
+                         ConditionExpression='attribute_exists(StateKey)',
+                         ExpressionAttributeValues={
+                             ':e': {'SS': [email]},
+                             ':one': {'N': '1'}})
+        result = True
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            LOGGER.info('No org snapshot to update with %s', email)
+        else:
+            LOGGER.error('Unable to update org snapshot: %s', str(exe))
+
+    if result and CACHE:
+        CACHE['Emails'].add(email)
+        CACHE['Version'] += 1
+
+    return result
@@ -9,10 +9,34 @@ echo "account_create.py"
 echo "================="
 pylint account_create.py | grep '^Your code has been rated'
 echo
+echo "apimetrics.py"
+echo "============="
+pylint apimetrics.py | grep '^Your code has been rated'
+echo
+echo "batchreport.py"
+echo "=============="
+pylint batchreport.py | grep '^Your code has been rated'
+echo
+echo "awsclients.py"
+echo "============="
+pylint awsclients.py | grep '^Your code has been rated'
+echo
+echo "dynotable.py"
+echo "============"
+pylint dynotable.py | grep '^Your code has been rated'
+echo
+echo "orgcache.py"
+echo "==========="
+pylint orgcache.py | grep '^Your code has been rated'
+echo
+echo "fanout.py"
+echo "========="
+pylint fanout.py | grep '^Your code has been rated'
+echo
 echo "Packging the files"
 echo "======== === ====="
-zip -r ct_batchcreation_lambda.zip new_account_handler.py cfnresource.py 
-zip -r ct_account_create_lambda.zip account_create.py cfnresource.py
+zip -r ct_batchcreation_lambda.zip new_account_handler.py apimetrics.py awsclients.py cfnresource.py dynotable.py fanout.py orgcache.py
+zip -r ct_account_create_lambda.zip account_create.py apimetrics.py awsclients.py batchreport.py cfnresource.py dynotable.py orgcache.py
 echo
 for region in $(aws ec2 describe-regions --query 'Regions[*].RegionName' --output text)
 do